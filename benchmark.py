@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# tzmap.js - Library for working with the geography of timezones in JavaScript
+
+# Written in 2011 by L. David Baron <dbaron@dbaron.org>
+
+# To the extent possible under law, the author(s) have dedicated all
+# copyright and related and neighboring rights to this software to the
+# public domain worldwide.  This software is distributed without any
+# warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication
+# along with this software.  If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+# Times pyshp and shapefile-to-json.py on a synthetic time zone
+# shapefile, so that they can be measured (and compared between
+# commits) without downloading tz_world.  For example:
+#
+#   ./benchmark.py --zones 2000 --vertices 1000 -o before.json
+
+import os
+import sys
+import json
+import math
+import time
+import array
+import random
+import shlex
+import shutil
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+
+BASEDIR = os.path.dirname(os.path.realpath(__file__))
+GENERATOR = os.path.join(BASEDIR, "shapefile-to-json.py")
+
+sys.path.append(os.path.join(BASEDIR, "pyshp"))
+import shapefile
+
+def side_points(a, b, n, bulge, noise, rnd):
+    """Returns n + 1 points (as a flat list) running from corner a to
+    corner b.  Each point between them is moved off the straight line,
+    to its left, by bulge plus a random amount up to noise, both scaled
+    down towards the corners, so that sides meeting at a corner only
+    touch there."""
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    length = math.hypot(dx, dy)
+    (nx, ny) = (-dy / length, dx / length)
+    points = [a[0], a[1]]
+    for k in range(1, n):
+        t = float(k) / n
+        offset = math.sin(math.pi * t) * (bulge + rnd.uniform(-noise, noise))
+        points.extend((a[0] + dx * t + nx * offset,
+                       a[1] + dy * t + ny * offset))
+    points.extend(b)
+    return points
+
+def reversed_points(points):
+    return [c for i in range(len(points) - 2, -1, -2)
+              for c in points[i:i + 2]]
+
+def write_shapefile(base, zones, vertices, shared, seed):
+    """Writes base.shp, base.shx and base.dbf with a TZID field, like
+    tz_world's.  The zones are the first cells, row by row, of a grid
+    over the world, and each has about the given number of vertices.
+    Each border between two zones is, with probability shared, one line
+    used by both; otherwise each zone bulges in from it, leaving water
+    between them."""
+    rnd = random.Random(seed)
+    columns = int(math.ceil(math.sqrt(zones)))
+    rows = int(math.ceil(float(zones) / columns))
+    cell = min(360.0 / columns, 160.0 / rows)
+    n = max(1, vertices // 4)
+    def corner(i, j):
+        return (-180 + i * cell, -80 + j * cell)
+    def exists(i, j):
+        return 0 <= i < columns and 0 <= j and j * columns + i < zones
+
+    # The shared sides, by their (left or bottom) corner and direction,
+    # running left to right or bottom to top.
+    sharedSides = {}
+    def side(i, j, horizontal, inward):
+        """Returns the points of the side starting at corner (i, j),
+        running left to right or bottom to top, for the cell above it
+        or to its left (inward == 1) or below it or to its right
+        (inward == -1)."""
+        if horizontal:
+            (a, b) = (corner(i, j), corner(i + 1, j))
+            cells = ((i, j), (i, j - 1))
+        else:
+            (a, b) = (corner(i, j), corner(i, j + 1))
+            cells = ((i - 1, j), (i, j))
+        key = (i, j, horizontal)
+        if exists(*cells[0]) and exists(*cells[1]):
+            if key not in sharedSides:
+                if rnd.random() < shared:
+                    sharedSides[key] = side_points(a, b, n, 0, 0.05 * cell, rnd)
+                else:
+                    sharedSides[key] = None
+            if sharedSides[key] is not None:
+                return list(sharedSides[key])
+        return side_points(a, b, n, inward * 0.2 * cell, 0.05 * cell, rnd)
+
+    w = shapefile.Writer(shapefile.POLYGON, base)
+    try:
+        w.field("TZID", "C", "80")
+        for z in range(zones):
+            (i, j) = (z % columns, z // columns)
+            # Clockwise: up the west side, along the north, down the
+            # east side, and back along the south.
+            ring = side(i, j, False, -1)
+            ring.extend(side(i, j + 1, True, -1)[2:])
+            ring.extend(reversed_points(side(i + 1, j, False, 1))[2:])
+            ring.extend(reversed_points(side(i, j, True, 1))[2:])
+            w.flatPoly(array.array("d", ring))
+            w.record("Bench/Zone{0:05d}".format(z))
+    finally:
+        w.close()
+
+def best_time(repeat, fn):
+    """Returns the shortest of repeat wall times of fn()."""
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def time_reader(base, repeat):
+    """Returns the best times of the ways of reading the shapefile."""
+    shp = base + ".shp"
+    return {
+        "shapes": best_time(repeat,
+                            lambda: shapefile.Reader(shp).shapes()),
+        "shapeRecords": best_time(repeat,
+                                  lambda: shapefile.Reader(shp).shapeRecords()),
+        # As shapefile-to-json.py reads it.
+        "flatShapeRecords": best_time(repeat,
+            lambda: shapefile.Reader(shp, mmap=True, flat=True)
+                             .shapeRecords(fields=["TZID"])),
+    }
+
+def time_generator(base, workDir, repeat, flags):
+    """Runs shapefile-to-json.py repeat times, and returns the --metrics
+    report of the fastest run."""
+    best = None
+    for r in range(repeat):
+        jsonFilename = os.path.join(workDir, "world-map.json")
+        dataFilename = os.path.join(workDir, "world-map.data")
+        metricsFilename = os.path.join(workDir, "metrics.json")
+        devnull = open(os.devnull, "w")
+        try:
+            subprocess.check_call([sys.executable, GENERATOR,
+                                   "--shapefile", base + ".shp",
+                                   "--metrics", metricsFilename] + flags +
+                                  [jsonFilename, dataFilename],
+                                  stderr=devnull)
+        finally:
+            devnull.close()
+        metricsIO = open(metricsFilename)
+        metrics = json.load(metricsIO)
+        metricsIO.close()
+        metrics["outputs"] = dict((os.path.basename(filename), size)
+                                  for (filename, size)
+                                  in metrics["outputs"].items())
+        metrics["wall"] = sum(phase["wall"] for phase in metrics["phases"])
+        if best is None or metrics["wall"] < best["wall"]:
+            best = metrics
+    return best
+
+def git_revision():
+    """Returns the commit of the working tree, or None."""
+    try:
+        devnull = open(os.devnull, "w")
+        try:
+            revision = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                               cwd=BASEDIR, stderr=devnull)
+        finally:
+            devnull.close()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision.decode("ascii").strip()
+
+def main():
+    op = OptionParser(usage="%prog [options]")
+    op.add_option("--zones", dest="zones", type="int", default=400,
+                  help="the number of zones (default 400)")
+    op.add_option("--vertices", dest="vertices", type="int", default=400,
+                  help="about how many vertices each zone has (default 400)")
+    op.add_option("--shared", dest="shared", type="float", default=0.8,
+                  help="the fraction of the borders between neighboring "
+                       "zones that they share (default 0.8)")
+    op.add_option("--seed", dest="seed", type="int", default=1,
+                  help="the seed for the random shapes (default 1)")
+    op.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                  help="how many times to time each thing, keeping the "
+                       "fastest (default 3)")
+    op.add_option("--generator-flags", dest="generatorFlags", default="",
+                  help="extra options for shapefile-to-json.py, e.g., "
+                       "\"-j 4\"")
+    op.add_option("--keep", dest="keepDir", default=None,
+                  help="write the shapefile and outputs to this directory "
+                       "and keep them, instead of using a temporary one")
+    op.add_option("-o", "--output", dest="output", default=None,
+                  help="write the results to this file instead of stdout")
+    (options, args) = op.parse_args()
+
+    if len(args) != 0:
+        op.error("unexpected arguments")
+    if options.zones < 1:
+        op.error("--zones must be at least 1")
+    if options.vertices < 4:
+        op.error("--vertices must be at least 4")
+    if not 0 <= options.shared <= 1:
+        op.error("--shared must be between 0 and 1")
+    if options.repeat < 1:
+        op.error("--repeat must be at least 1")
+
+    if options.keepDir is not None:
+        workDir = options.keepDir
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+    else:
+        workDir = tempfile.mkdtemp(prefix="tzmap-benchmark-")
+    try:
+        base = os.path.join(workDir, "bench")
+        sys.stderr.write("Writing the shapefile.\n")
+        start = time.time()
+        write_shapefile(base, options.zones, options.vertices,
+                        options.shared, options.seed)
+        writeTime = time.time() - start
+        sys.stderr.write("Timing the Reader.\n")
+        reader = time_reader(base, options.repeat)
+        sys.stderr.write("Timing shapefile-to-json.py.\n")
+        generator = time_generator(base, workDir, options.repeat,
+                                   shlex.split(options.generatorFlags))
+        results = {
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "parameters": { "zones": options.zones,
+                            "vertices": options.vertices,
+                            "shared": options.shared,
+                            "seed": options.seed,
+                            "repeat": options.repeat,
+                            "generatorFlags": options.generatorFlags },
+            "shapefile": dict((ext, os.path.getsize(base + "." + ext))
+                              for ext in ("shp", "shx", "dbf")),
+            "writer": writeTime,
+            "reader": reader,
+            "generator": generator,
+        }
+    finally:
+        if options.keepDir is None:
+            shutil.rmtree(workDir)
+
+    if options.output is not None:
+        outputIO = open(options.output, "w")
+    else:
+        outputIO = sys.stdout
+    json.dump(results, outputIO, indent=2, sort_keys=True)
+    outputIO.write("\n")
+    if options.output is not None:
+        outputIO.close()
+
+if __name__ == "__main__":
+    main()
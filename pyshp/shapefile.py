@@ -10,13 +10,23 @@ version changelog: Reader.iterShapeRecords() bugfix for Python 3
 
 __version__ = "1.2.3"
 
-from struct import pack, unpack, calcsize, error
+from struct import Struct, pack, unpack, unpack_from, error
 import os
 import sys
 import time
 import array
+import mmap
+import io
+import shutil
 import tempfile
+import zipfile
 import itertools
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #
 # Constants for shape types
@@ -37,6 +47,13 @@ MULTIPATCH = 31
 
 PYTHON3 = sys.version_info[0] == 3
 
+# Number of dbf records read at a time by Reader.iterRecords()
+DBF_BLOCK_RECORDS = 1024
+
+# Zip archive members up to this size are read into memory; larger ones
+# are copied to an anonymous temporary file.
+ZIP_SPOOL_SIZE = 256 * 1024 * 1024
+
 if PYTHON3:
     xrange = range
     izip = zip
@@ -88,6 +105,165 @@ def is_string(v):
     else:
         return isinstance(v, basestring)
 
+def _mapFile(f):
+    """Returns a read-only buffer over the whole contents of a file-like
+    object without copying it: the internal buffer of an in-memory
+    file, or a memory map of a real file.  Returns None if neither is
+    possible, in which case the caller should fall back to reading."""
+    if hasattr(f, "getbuffer"):
+        return f.getbuffer()
+    try:
+        fileno = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    if os.fstat(fileno).st_size == 0:
+        return None
+    m = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    try:
+        return memoryview(m)
+    except TypeError:
+        # Python 2 mmap objects don't export the buffer interface to
+        # memoryview, but unpack_from can still read them directly.
+        return m
+
+def _bulkArray(typecode, data, byteorder):
+    """Builds an array of the given type from raw bytes stored in the given
+    byte order ("little" or "big") in one operation."""
+    a = _Array(typecode)
+    if PYTHON3:
+        a.frombytes(data)
+    else:
+        a.fromstring(bytes(data))
+    if sys.byteorder != byteorder:
+        a.byteswap()
+    return a
+
+def _flatPoints(buf, pos, nPoints):
+    """Decodes nPoints little-endian x,y pairs starting at pos in buf into
+    a single flat sequence of interleaved x and y values, using one bulk
+    operation rather than one per point.  The result is a read-only NumPy
+    array sharing memory with buf when NumPy is available, and an
+    array('d') otherwise."""
+    if numpy is not None:
+        return numpy.frombuffer(buf, dtype="<f8", count=2 * nPoints, offset=pos)
+    return _bulkArray('d', buf[pos:pos + 16 * nPoints], "little")
+
+def _isFlat(points):
+    """Returns whether points is a flat sequence of interleaved x and y
+    values rather than a sequence of points."""
+    if numpy is not None and isinstance(points, numpy.ndarray):
+        return points.ndim == 1
+    return isinstance(points, array.array)
+
+def _flatCoords(points):
+    """Returns the x,y coordinates of points as a flat sequence of
+    interleaved x and y values.  points may be a list of [x, y, ...]
+    points, a flat array('d') or NumPy array, or an (n, 2) or wider
+    NumPy array."""
+    if numpy is not None and isinstance(points, numpy.ndarray):
+        if points.ndim == 2:
+            return numpy.ascontiguousarray(points[:, :2], dtype=float).ravel()
+        return points
+    if isinstance(points, array.array):
+        return points
+    return _Array('d', itertools.chain.from_iterable(p[:2] for p in points))
+
+def _flatBbox(coords):
+    """Returns [xmin, ymin, xmax, ymax] of a flat coordinate sequence."""
+    xs = coords[0::2]
+    ys = coords[1::2]
+    if numpy is not None and isinstance(coords, numpy.ndarray):
+        return [float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def _packArray(typecode, values):
+    """Packs a sequence of numbers as little-endian values of the given
+    array type code ('i' or 'd') in one operation."""
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.astype(typecode == 'd' and "<f8" or "<i4").tobytes()
+    if not (isinstance(values, array.array) and values.typecode == typecode) \
+       or sys.byteorder != "little":
+        values = _Array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    if PYTHON3:
+        return values.tobytes()
+    return values.tostring()
+
+def _pointPairs(points):
+    """Returns a list of [x, y] points for either a list of points or a
+    flat sequence of interleaved x and y values."""
+    if len(points) and not hasattr(points[0], "__len__"):
+        return [points[i:i + 2] for i in xrange(0, len(points), 2)]
+    return points
+
+def _zipMember(zf, info):
+    """Copies a member of an open zip archive into a seekable buffer.  The
+    compressed stream is only ever read forwards, once."""
+    if info.file_size <= ZIP_SPOOL_SIZE:
+        return io.BytesIO(zf.read(info))
+    f = tempfile.TemporaryFile()
+    src = zf.open(info)
+    try:
+        shutil.copyfileobj(src, f, 1024 * 1024)
+    finally:
+        src.close()
+    f.seek(0)
+    return f
+
+def _decodeShapes(task):
+    """Process pool worker for Reader.shapes(workers=N).  A task either
+    names a .shp file together with the offsets (in 16-bit words) of
+    the records to decode from it, or carries the bytes of a .shp file
+    header followed by a run of consecutive records."""
+    (source, offsets, options) = task
+    if offsets is None:
+        return Reader(shp=io.BytesIO(source), **options).shapes()
+    shp = open(source, "rb")
+    try:
+        return Reader(shp=shp, **options)._shapesAt(offsets)
+    finally:
+        shp.close()
+
+def _dbfConverter(typ, deci):
+    """Returns a function that converts the raw bytes of a dbf field of
+    the given type into a value.  Blank fields are returned as is."""
+    if typ == "N":
+        def convert(value):
+            if not value.strip():
+                return value
+            value = value.replace(b('\0'), b('')).strip()
+            value = value.replace(b('*'), b(''))  # QGIS NULL is all '*' chars
+            if value == b(''):
+                return None
+            elif deci:
+                return float(value)
+            else:
+                return int(value)
+    elif typ == b('D'):
+        def convert(value):
+            if not value.strip():
+                return value
+            if value.count(b('0')) == len(value):  # QGIS NULL is all '0' chars
+                return None
+            try:
+                y, m, d = int(value[:4]), int(value[4:6]), int(value[6:8])
+                return [y, m, d]
+            except:
+                return value.strip()
+    elif typ == b('L'):
+        def convert(value):
+            if not value.strip():
+                return value
+            return (value in b('YyTt') and b('T')) or \
+                   (value in b('NnFf') and b('F')) or b('?')
+    else:
+        def convert(value):
+            if not value.strip():
+                return value
+            return u(value).strip()
+    return convert
+
 class _Array(array.array):
     """Converts python tuples to lits of the appropritate type.
     Used to unpack different shapefile header parts."""
@@ -120,21 +296,22 @@ class _Shape:
 
     @property
     def __geo_interface__(self):
+        points = _pointPairs(self.points)
         if self.shapeType in [POINT, POINTM, POINTZ]:
             return {
             'type': 'Point',
-            'coordinates': tuple(self.points[0])
+            'coordinates': tuple(points[0])
             }
         elif self.shapeType in [MULTIPOINT, MULTIPOINTM, MULTIPOINTZ]:
             return {
             'type': 'MultiPoint',
-            'coordinates': tuple([tuple(p) for p in self.points])
+            'coordinates': tuple([tuple(p) for p in points])
             }
         elif self.shapeType in [POLYLINE, POLYLINEM, POLYLINEZ]:
             if len(self.parts) == 1:
                 return {
                 'type': 'LineString',
-                'coordinates': tuple([tuple(p) for p in self.points])
+                'coordinates': tuple([tuple(p) for p in points])
                 }
             else:
                 ps = None
@@ -144,10 +321,10 @@ class _Shape:
                         ps = part
                         continue
                     else:
-                        coordinates.append(tuple([tuple(p) for p in self.points[ps:part]]))
+                        coordinates.append(tuple([tuple(p) for p in points[ps:part]]))
                         ps = part
                 else:
-                    coordinates.append(tuple([tuple(p) for p in self.points[part:]]))
+                    coordinates.append(tuple([tuple(p) for p in points[part:]]))
                 return {
                 'type': 'MultiLineString',
                 'coordinates': tuple(coordinates)
@@ -156,7 +333,7 @@ class _Shape:
             if len(self.parts) == 1:
                 return {
                 'type': 'Polygon',
-                'coordinates': (tuple([tuple(p) for p in self.points]),)
+                'coordinates': (tuple([tuple(p) for p in points]),)
                 }
             else:
                 ps = None
@@ -166,10 +343,10 @@ class _Shape:
                         ps = part
                         continue
                     else:
-                        coordinates.append(tuple([tuple(p) for p in self.points[ps:part]]))
+                        coordinates.append(tuple([tuple(p) for p in points[ps:part]]))
                         ps = part
                 else:
-                    coordinates.append(tuple([tuple(p) for p in self.points[part:]]))
+                    coordinates.append(tuple([tuple(p) for p in points[part:]]))
                 polys = []
                 poly = [coordinates[0]]
                 for coord in coordinates[1:]:
@@ -210,6 +387,12 @@ class Reader:
     file. The "shapefile" argument in the constructor is the
     name of the file you want to open.
 
+    A shapefile can also be read straight out of a zip archive by
+    passing the archive's file name and the name of the shapefile
+    within it, with or without extension, e.g.
+    Reader("tz_world_mp.zip", "world/tz_world_mp").  If the archive
+    contains a single shapefile the second argument may be omitted.
+
     You can instantiate a Reader without specifying a shapefile
     and then specify one later with the load() method.
 
@@ -217,21 +400,43 @@ class Reader:
     within each file is only accessed when required and as
     efficiently as possible. Shapefiles are usually not large
     but they can be.
+
+    Passing mmap=True memory-maps the three files and decodes
+    geometry and attribute records directly from the mapped
+    buffers instead of issuing a read for each field.  File-like
+    objects that are neither real files nor in-memory buffers are
+    read normally.
+
+    Passing flat=True makes the points of each multi-point shape a
+    single flat sequence of interleaved x and y values (a NumPy
+    array if NumPy is installed, otherwise an array('d')) instead of
+    a list of [x, y] arrays.  Parts remain point offsets, so part k
+    starts at points[2 * parts[k]].
     """
     def __init__(self, *args, **kwargs):
         self.shp = None
         self.shx = None
         self.dbf = None
+        self.useMmap = kwargs.get("mmap", False)
+        self.flat = kwargs.get("flat", False)
+        self._shpBuffer = None
+        self._shxBuffer = None
+        self._dbfBuffer = None
         self.shapeName = "Not specified"
-        self._offsets = []
+        self._offsets = None
+        self._lengths = None
         self.shpLength = None
         self.numRecords = None
         self.fields = []
         self.__dbfHdrLength = 0
+        self.__recordLayouts = {}
         # See if a shapefile name was passed as an argument
         if len(args) > 0:
             if is_string(args[0]):
-                self.load(args[0])
+                if len(args) > 1 or os.path.splitext(args[0])[1].lower() == ".zip":
+                    self.loadZip(*args[:2])
+                else:
+                    self.load(args[0])
                 return
         if "shp" in kwargs.keys():
             if hasattr(kwargs["shp"], "read"):
@@ -268,16 +473,61 @@ class Reader:
             try:
                 self.shx = open("%s.shx" % shapeName, "rb")
             except IOError:
-                raise ShapefileException("Unable to open %s.shx" % shapeName)
+                # The index can be rebuilt from the .shp file.
+                self.shx = None
             try:
                 self.dbf = open("%s.dbf" % shapeName, "rb")
             except IOError:
                 raise ShapefileException("Unable to open %s.dbf" % shapeName)
+        if self.useMmap:
+            self.__mapFiles()
         if self.shp:
             self.__shpHeader()
         if self.dbf:
             self.__dbfHeader()
 
+    def loadZip(self, zipName, member=None):
+        """Opens a shapefile stored in a zip archive.  member is the name
+        of the shapefile within the archive; it may be omitted if the
+        archive contains only one .shp file.  Each of the three files is
+        decompressed once, sequentially, into a seekable buffer."""
+        try:
+            zf = zipfile.ZipFile(zipName, "r")
+        except (IOError, zipfile.BadZipfile):
+            raise ShapefileException("Unable to open %s" % zipName)
+        try:
+            if member is None:
+                shpNames = [n for n in zf.namelist()
+                            if os.path.splitext(n)[1].lower() == ".shp"]
+                if len(shpNames) != 1:
+                    raise ShapefileException("%s does not contain exactly one .shp file" % zipName)
+                member = shpNames[0]
+            (shapeName, ext) = os.path.splitext(member)
+            if ext.lower() not in (".shp", ".shx", ".dbf"):
+                shapeName = member
+            self.shapeName = shapeName
+            for ext in ("shp", "shx", "dbf"):
+                try:
+                    info = zf.getinfo("%s.%s" % (shapeName, ext))
+                except KeyError:
+                    if ext == "shx":
+                        # The index can be rebuilt from the .shp file.
+                        continue
+                    raise ShapefileException("Unable to find %s.%s in %s" % (shapeName, ext, zipName))
+                setattr(self, ext, _zipMember(zf, info))
+        finally:
+            zf.close()
+        self.load()
+
+    def __mapFiles(self):
+        """Maps whichever of the three files are open into memory."""
+        if self.shp and self._shpBuffer is None:
+            self._shpBuffer = _mapFile(self.shp)
+        if self.shx and self._shxBuffer is None:
+            self._shxBuffer = _mapFile(self.shx)
+        if self.dbf and self._dbfBuffer is None:
+            self._dbfBuffer = _mapFile(self.dbf)
+
     def __getFileObj(self, f):
         """Checks to see if the requested shapefile file object is
         available. If not a ShapefileException is raised."""
@@ -320,82 +570,151 @@ class Reader:
     def __shape(self):
         """Returns the header info and geometry for a single shape."""
         f = self.__getFileObj(self.shp)
+        if self._shpBuffer is not None:
+            offset = f.tell()
+            record = self.__shapeAt(offset)
+            f.seek(offset + 8 + 2 * unpack_from(">i", self._shpBuffer, offset + 4)[0])
+            return record
+        (recNum, recLength) = unpack(">2i", f.read(8))
+        # Read the whole record in one go.  This also leaves us at the
+        # start of the next record as defined by the record header,
+        # because the shapefile spec doesn't require the actual content
+        # to meet the header definition.  Probably allowed for lazy
+        # feature deletion.
+        return self.__decodeShape(f.read(2 * recLength), 0)
+
+    def __shapeAt(self, offset):
+        """Returns the shape whose record header starts at offset in the
+        memory-mapped .shp file."""
+        return self.__decodeShape(self._shpBuffer, offset + 8)
+
+    def __decodeShape(self, buf, pos):
+        """Decodes the geometry of a single shape from buf, starting at
+        the shape type that follows the record header."""
         record = _Shape()
         nParts = nPoints = zmin = zmax = mmin = mmax = None
-        (recNum, recLength) = unpack(">2i", f.read(8))
-        # Determine the start of the next record
-        next = f.tell() + (2 * recLength)
-        shapeType = unpack("<i", f.read(4))[0]
+        shapeType = unpack_from("<i", buf, pos)[0]
+        pos += 4
         record.shapeType = shapeType
         # For Null shapes create an empty points list for consistency
         if shapeType == 0:
             record.points = []
         # All shape types capable of having a bounding box
         elif shapeType in (3,5,8,13,15,18,23,25,28,31):
-            record.bbox = _Array('d', unpack("<4d", f.read(32)))
+            record.bbox = _Array('d', unpack_from("<4d", buf, pos))
+            pos += 32
         # Shape types with parts
         if shapeType in (3,5,13,15,23,25,31):
-            nParts = unpack("<i", f.read(4))[0]
+            nParts = unpack_from("<i", buf, pos)[0]
+            pos += 4
         # Shape types with points
         if shapeType in (3,5,8,13,15,23,25,31):
-            nPoints = unpack("<i", f.read(4))[0]
+            nPoints = unpack_from("<i", buf, pos)[0]
+            pos += 4
         # Read parts
         if nParts:
-            record.parts = _Array('i', unpack("<%si" % nParts, f.read(nParts * 4)))
+            record.parts = _Array('i', unpack_from("<%si" % nParts, buf, pos))
+            pos += nParts * 4
         # Read part types for Multipatch - 31
         if shapeType == 31:
-            record.partTypes = _Array('i', unpack("<%si" % nParts, f.read(nParts * 4)))
-        # Read points - produces a list of [x,y] values
-        if nPoints:
-            record.points = [_Array('d', unpack("<2d", f.read(16))) for p in range(nPoints)]
+            record.partTypes = _Array('i', unpack_from("<%si" % nParts, buf, pos))
+            pos += nParts * 4
+        # Read points - produces a list of [x,y] values, or a flat
+        # sequence of x,y values if requested
+        if nPoints and self.flat:
+            record.points = _flatPoints(buf, pos, nPoints)
+            pos += nPoints * 16
+        elif nPoints:
+            coords = unpack_from("<%sd" % (2 * nPoints), buf, pos)
+            pos += nPoints * 16
+            record.points = [_Array('d', coords[p:p + 2]) for p in xrange(0, 2 * nPoints, 2)]
         # Read z extremes and values
         if shapeType in (13,15,18,31):
-            (zmin, zmax) = unpack("<2d", f.read(16))
-            record.z = _Array('d', unpack("<%sd" % nPoints, f.read(nPoints * 8)))
+            (zmin, zmax) = unpack_from("<2d", buf, pos)
+            record.z = _Array('d', unpack_from("<%sd" % nPoints, buf, pos + 16))
+            pos += 16 + nPoints * 8
         # Read m extremes and values if header m values do not equal 0.0
         if shapeType in (13,15,18,23,25,28,31) and not 0.0 in self.measure:
-            (mmin, mmax) = unpack("<2d", f.read(16))
+            (mmin, mmax) = unpack_from("<2d", buf, pos)
             # Measure values less than -10e38 are nodata values according to the spec
             record.m = []
-            for m in _Array('d', unpack("<%sd" % nPoints, f.read(nPoints * 8))):
+            for m in _Array('d', unpack_from("<%sd" % nPoints, buf, pos + 16)):
                 if m > -10e38:
                     record.m.append(m)
                 else:
                     record.m.append(None)
+            pos += 16 + nPoints * 8
         # Read a single point
         if shapeType in (1,11,21):
-            record.points = [_Array('d', unpack("<2d", f.read(16)))]
+            record.points = [_Array('d', unpack_from("<2d", buf, pos))]
+            pos += 16
         # Read a single Z value
         if shapeType == 11:
-            record.z = unpack("<d", f.read(8))
+            record.z = unpack_from("<d", buf, pos)
+            pos += 8
         # Read a single M value
         if shapeType in (11,21):
-            record.m = unpack("<d", f.read(8))
-        # Seek to the end of this record as defined by the record header because
-        # the shapefile spec doesn't require the actual content to meet the header
-        # definition.  Probably allowed for lazy feature deletion. 
-        f.seek(next)
+            record.m = unpack_from("<d", buf, pos)
         return record
 
     def __shapeIndex(self, i=None):
-        """Returns the offset in a .shp file for a shape based on information
-        in the .shx index file."""
+        """Returns the offset in a .shp file for a shape.  The offsets and
+        content lengths of all shapes are loaded on first use, with one
+        bulk read of the .shx index file or, if there is none, with a
+        single pass over the record headers of the .shp file."""
+        if self._offsets is None:
+            if self.shx:
+                self.__readShapeIndex()
+            else:
+                self.__buildShapeIndex()
+        if not i == None:
+            # Offsets are 16-bit words just like the file length
+            return self._offsets[i] * 2
+
+    def __readShapeIndex(self):
+        """Loads the record offsets and lengths from the .shx file."""
         shx = self.shx
-        if not shx:
-            return None
-        if not self._offsets:
-            # File length (16-bit word * 2 = bytes) - header length
-            shx.seek(24)
-            shxRecordLength = (unpack(">i", shx.read(4))[0] * 2) - 100
-            numRecords = shxRecordLength // 8
+        # File length (16-bit word * 2 = bytes) - header length
+        shx.seek(24)
+        shxRecordLength = (unpack(">i", shx.read(4))[0] * 2) - 100
+        numRecords = shxRecordLength // 8
+        if self._shxBuffer is not None:
+            data = self._shxBuffer[100:100 + 8 * numRecords]
+        else:
             # Jump to the first record.
             shx.seek(100)
-            for r in range(numRecords):
-                # Offsets are 16-bit words just like the file length
-                self._offsets.append(unpack(">i", shx.read(4))[0] * 2)
-                shx.seek(shx.tell() + 4)
-        if not i == None:
-            return self._offsets[i]
+            data = shx.read(8 * numRecords)
+        # Pairs of big-endian (offset, content length) words
+        index = _bulkArray('i', data, "big")
+        self._offsets = index[0::2]
+        self._lengths = index[1::2]
+
+    def __buildShapeIndex(self):
+        """Rebuilds the record offsets and lengths that the .shx file
+        would hold from the record headers of the .shp file, skipping
+        over the record contents."""
+        shp = self.__getFileObj(self.shp)
+        shp.seek(0,2)
+        shpLength = shp.tell()
+        offsets = _Array('i')
+        lengths = _Array('i')
+        offset = 100
+        if self._shpBuffer is not None:
+            buf = self._shpBuffer
+            while offset < shpLength:
+                recLength = unpack_from(">i", buf, offset + 4)[0]
+                offsets.append(offset // 2)
+                lengths.append(recLength)
+                offset += 8 + 2 * recLength
+        else:
+            while offset < shpLength:
+                shp.seek(offset + 4)
+                recLength = unpack(">i", shp.read(4))[0]
+                offsets.append(offset // 2)
+                lengths.append(recLength)
+                offset += 8 + 2 * recLength
+        self._offsets = offsets
+        self._lengths = lengths
 
     def shape(self, i=0):
         """Returns a shape object for a shape in the the geometry
@@ -403,16 +722,13 @@ class Reader:
         shp = self.__getFileObj(self.shp)
         i = self.__restrictIndex(i)
         offset = self.__shapeIndex(i)
-        if not offset:
-            # Shx index not available so iterate the full list.
-            for j,k in enumerate(self.iterShapes()):
-                if j == i:
-                    return k
+        if self._shpBuffer is not None:
+            return self.__shapeAt(offset)
         shp.seek(offset)
         return self.__shape()
 
-    def shapes(self):
-        """Returns all shapes in a shapefile."""
+    def __iterShapes(self):
+        """Yields every shape in the geometry record file in order."""
         shp = self.__getFileObj(self.shp)
         # Found shapefiles which report incorrect
         # shp file length in the header. Can't trust
@@ -420,21 +736,145 @@ class Reader:
         # and figure it out.
         shp.seek(0,2)
         self.shpLength = shp.tell()
+        if self._shpBuffer is not None:
+            buf = self._shpBuffer
+            offset = 100
+            while offset < self.shpLength:
+                yield self.__shapeAt(offset)
+                offset += 8 + 2 * unpack_from(">i", buf, offset + 4)[0]
+            return
         shp.seek(100)
-        shapes = []
         while shp.tell() < self.shpLength:
-            shapes.append(self.__shape())
-        return shapes
-
-    def iterShapes(self):
-        """Serves up shapes in a shapefile as an iterator. Useful
-        for handling large shapefiles."""
+            yield self.__shape()
+
+    def __iterShapesIn(self, bbox):
+        """Yields (index, shape) for each shape that intersects bbox, a
+        [xmin, ymin, xmax, ymax] box.  Only the record header and the
+        stored bounding box (or the point, for point shapes) of each
+        record are read to decide; other records are never decoded.
+        Null shapes never match."""
         shp = self.__getFileObj(self.shp)
         shp.seek(0,2)
         self.shpLength = shp.tell()
-        shp.seek(100)
-        while shp.tell() < self.shpLength:
-            yield self.__shape()    
+        (xmin, ymin, xmax, ymax) = bbox[:4]
+        buf = self._shpBuffer
+        offset = 100
+        i = 0
+        while offset < self.shpLength:
+            if buf is not None:
+                header = buf[offset:offset + 44]
+            else:
+                shp.seek(offset)
+                header = shp.read(44)
+            (recNum, recLength) = unpack_from(">2i", header)
+            shapeType = unpack_from("<i", header, 8)[0]
+            if shapeType in (3,5,8,13,15,18,23,25,28,31):
+                (sxmin, symin, sxmax, symax) = unpack_from("<4d", header, 12)
+            elif shapeType in (1,11,21):
+                (sxmin, symin) = (sxmax, symax) = unpack_from("<2d", header, 12)
+            else:
+                sxmin = None
+            if sxmin is not None and not (sxmin > xmax or sxmax < xmin or
+                                          symin > ymax or symax < ymin):
+                if buf is not None:
+                    yield (i, self.__shapeAt(offset))
+                else:
+                    shp.seek(offset)
+                    yield (i, self.__shape())
+            offset += 8 + 2 * recLength
+            i += 1
+
+    def _shapesAt(self, offsets):
+        """Returns the shapes whose records start at the given offsets, in
+        16-bit words as stored in the .shx file."""
+        shp = self.__getFileObj(self.shp)
+        shapes = []
+        for offset in offsets:
+            if self._shpBuffer is not None:
+                shapes.append(self.__shapeAt(offset * 2))
+            else:
+                shp.seek(offset * 2)
+                shapes.append(self.__shape())
+        return shapes
+
+    def __shapeTasks(self, workers):
+        """Splits the records into about four runs per worker, balanced
+        by content length, and yields a _decodeShapes task for each.  If
+        the .shp file is a real file each worker opens it for itself;
+        otherwise the header and the run's records are sent along."""
+        shp = self.__getFileObj(self.shp)
+        self.__shapeIndex()
+        offsets = self._offsets
+        lengths = self._lengths
+        options = {"mmap": self.useMmap, "flat": self.flat}
+        shpName = getattr(shp, "name", None)
+        if not (is_string(shpName) and os.path.isfile(shpName)):
+            shpName = None
+            if self._shpBuffer is not None:
+                header = bytes(self._shpBuffer[:100])
+            else:
+                shp.seek(0)
+                header = shp.read(100)
+        numRecords = len(offsets)
+        numRuns = min(numRecords, workers * 4)
+        total = sum(lengths) + 4 * numRecords
+        start = 0
+        done = 0
+        for run in range(numRuns):
+            stop = start
+            target = total * (run + 1) // numRuns
+            while stop < numRecords and (done < target or stop == start):
+                done += lengths[stop] + 4
+                stop += 1
+            if run == numRuns - 1:
+                stop = numRecords
+            if stop == start:
+                continue
+            if shpName is not None:
+                yield (shpName, offsets[start:stop], options)
+            else:
+                first = offsets[start] * 2
+                last = (offsets[stop - 1] + lengths[stop - 1]) * 2 + 8
+                if self._shpBuffer is not None:
+                    records = bytes(self._shpBuffer[first:last])
+                else:
+                    shp.seek(first)
+                    records = shp.read(last - first)
+                yield (header + records, None, options)
+            start = stop
+
+    def __parallelShapes(self, workers):
+        """Decodes the shapes in a pool of worker processes and yields
+        them in file order."""
+        pool = multiprocessing.Pool(workers)
+        try:
+            for shapes in pool.imap(_decodeShapes, self.__shapeTasks(workers)):
+                for shape in shapes:
+                    yield shape
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def shapes(self, workers=None):
+        """Returns all shapes in a shapefile.  If workers is greater than
+        one, the records are decoded by that many worker processes and
+        returned in the same order."""
+        if workers and workers > 1:
+            return list(self.__parallelShapes(workers))
+        return list(self.__iterShapes())
+
+    def iterShapes(self, bbox=None, workers=None):
+        """Serves up shapes in a shapefile as an iterator. Useful
+        for handling large shapefiles.  If bbox is given as
+        [xmin, ymin, xmax, ymax], only the shapes whose bounding box
+        intersects it are decoded and returned.  Otherwise, if workers
+        is greater than one, the records are decoded by that many
+        worker processes and still served up in order."""
+        if bbox is not None:
+            return (shape for (i, shape) in self.__iterShapesIn(bbox))
+        if workers and workers > 1:
+            return self.__parallelShapes(workers)
+        return self.__iterShapes()
 
     def __dbfHeaderLength(self):
         """Retrieves the header length of a dbf file header."""
@@ -473,114 +913,192 @@ class Reader:
 
     def __recordFmt(self):
         """Calculates the size of a .shp geometry record."""
-        if not self.numRecords:
-            self.__dbfHeader()
-        fmt = ''.join(['%ds' % fieldinfo[2] for fieldinfo in self.fields])
-        fmtSize = calcsize(fmt)
-        return (fmt, fmtSize)
+        recordStruct = self.__recordLayout()[0]
+        return (recordStruct.format, recordStruct.size)
+
+    def __recordLayout(self, fields=None):
+        """Compiles a dbf record layout once: a struct.Struct that splits a
+        row into the raw bytes of the deletion flag and each field, and a
+        list of (column, converter) pairs that turn those bytes into
+        values.  If fields is a list of field names, the layout only
+        extracts those fields, in that order; the bytes of the other
+        fields are skipped as padding."""
+        key = None if fields is None else tuple(fields)
+        if key not in self.__recordLayouts:
+            if not self.numRecords:
+                self.__dbfHeader()
+            names = [fieldinfo[0] for fieldinfo in self.fields]
+            if fields is not None:
+                for name in fields:
+                    if name not in names[1:]:
+                        raise ShapefileException("No field named %s in the dbf file." % name)
+            fmt = []
+            columns = {}
+            for (name, typ, size, deci) in self.fields:
+                if fields is None or name == 'DeletionFlag' or name in fields:
+                    columns[name] = len(columns)
+                    fmt.append('%ds' % size)
+                else:
+                    fmt.append('%dx' % size)
+            if fields is None:
+                converters = [(column, _dbfConverter(typ, deci))
+                              for (column, (name, typ, size, deci))
+                              in enumerate(self.fields)
+                              if name != 'DeletionFlag']
+            else:
+                converters = []
+                for name in fields:
+                    (name, typ, size, deci) = self.fields[names.index(name, 1)]
+                    converters.append((columns[name], _dbfConverter(typ, deci)))
+            self.__recordLayouts[key] = (Struct(''.join(fmt)), converters)
+        return self.__recordLayouts[key]
+
+    def __record(self, offset=None, fields=None):
+        """Reads and returns a dbf record row as a list of values.  With
+        a memory-mapped dbf the row at offset is decoded in place."""
+        (recordStruct, converters) = self.__recordLayout(fields)
+        if self._dbfBuffer is not None:
+            recordContents = recordStruct.unpack_from(self._dbfBuffer, offset)
+        else:
+            f = self.__getFileObj(self.dbf)
+            recordContents = recordStruct.unpack(f.read(recordStruct.size))
+        return self.__decodeRecord(recordContents, converters)
 
-    def __record(self):
-        """Reads and returns a dbf record row as a list of values."""
-        f = self.__getFileObj(self.dbf)
-        recFmt = self.__recordFmt()
-        recordContents = unpack(recFmt[0], f.read(recFmt[1]))
+    def __decodeRecord(self, recordContents, converters):
+        """Converts the raw field values of a row, or returns None for a
+        deleted row."""
         if recordContents[0] != b(' '):
             # deleted record
             return None
-        record = []
-        for (name, typ, size, deci), value in zip(self.fields,
-                                                                                                recordContents):
-            if name == 'DeletionFlag':
-                continue
-            elif not value.strip():
-                record.append(value)
-                continue
-            elif typ == "N":
-                value = value.replace(b('\0'), b('')).strip()
-                value = value.replace(b('*'), b(''))  # QGIS NULL is all '*' chars
-                if value == b(''):
-                    value = None
-                elif deci:
-                    value = float(value)
-                else:
-                    value = int(value)
-            elif typ == b('D'):
-                if value.count(b('0')) == len(value):  # QGIS NULL is all '0' chars
-                    value = None
-                else:
-                    try:
-                        y, m, d = int(value[:4]), int(value[4:6]), int(value[6:8])
-                        value = [y, m, d]
-                    except:
-                        value = value.strip()
-            elif typ == b('L'):
-                value = (value in b('YyTt') and b('T')) or \
-                                        (value in b('NnFf') and b('F')) or b('?')
-            else:
-                value = u(value)
-                value = value.strip()
-            record.append(value)
-        return record
-
-    def record(self, i=0):
-        """Returns a specific dbf record based on the supplied index."""
+        return [convert(recordContents[column])
+                for (column, convert) in converters]
+
+    def __rawRecords(self, start, count, fields=None):
+        """Reads count consecutive rows starting at row start with a single
+        read, and returns an iterator over their raw field values."""
+        recordStruct = self.__recordLayout(fields)[0]
+        offset = self.__dbfHeaderLength() + start * recordStruct.size
+        size = count * recordStruct.size
+        if self._dbfBuffer is not None:
+            data = self._dbfBuffer[offset:offset + size]
+        else:
+            f = self.__getFileObj(self.dbf)
+            f.seek(offset)
+            data = f.read(size)
+        if len(data) != size:
+            raise ShapefileException("Shapefile dbf file is shorter than its header says. (likely corrupt?)")
+        if hasattr(recordStruct, "iter_unpack"):
+            return recordStruct.iter_unpack(data)
+        return (recordStruct.unpack_from(data, i * recordStruct.size)
+                for i in xrange(count))
+
+    def record(self, i=0, fields=None):
+        """Returns a specific dbf record based on the supplied index.  If
+        fields is a list of field names, only those fields are decoded
+        and returned, in that order."""
         f = self.__getFileObj(self.dbf)
         if not self.numRecords:
             self.__dbfHeader()
         i = self.__restrictIndex(i)
         recSize = self.__recordFmt()[1]
+        offset = self.__dbfHeaderLength() + (i * recSize)
         f.seek(0)
-        f.seek(self.__dbfHeaderLength() + (i * recSize))
-        return self.__record()
+        f.seek(offset)
+        return self.__record(offset, fields)
 
-    def records(self):
-        """Returns all records in a dbf file."""
+    def records(self, fields=None):
+        """Returns all records in a dbf file.  If fields is a list of
+        field names, only those fields are decoded and returned, in that
+        order."""
         if not self.numRecords:
             self.__dbfHeader()
+        self.__getFileObj(self.dbf)
+        converters = self.__recordLayout(fields)[1]
         records = []
-        f = self.__getFileObj(self.dbf)
-        f.seek(self.__dbfHeaderLength())
-        for i in range(self.numRecords):
-            r = self.__record()
+        for recordContents in self.__rawRecords(0, self.numRecords, fields):
+            r = self.__decodeRecord(recordContents, converters)
             if r:
                 records.append(r)
         return records
 
-    def iterRecords(self):
+    def iterRecords(self, fields=None):
         """Serves up records in a dbf file as an iterator.
-        Useful for large shapefiles or dbf files."""
+        Useful for large shapefiles or dbf files.  See records()
+        for fields."""
         if not self.numRecords:
             self.__dbfHeader()
-        f = self.__getFileObj(self.dbf)
-        f.seek(self.__dbfHeaderLength())
-        for i in xrange(self.numRecords):
-            r = self.__record()
-            if r:
-                yield r
-
-    def shapeRecord(self, i=0):
+        self.__getFileObj(self.dbf)
+        converters = self.__recordLayout(fields)[1]
+        for start in xrange(0, self.numRecords, DBF_BLOCK_RECORDS):
+            count = min(DBF_BLOCK_RECORDS, self.numRecords - start)
+            for recordContents in self.__rawRecords(start, count, fields):
+                r = self.__decodeRecord(recordContents, converters)
+                if r:
+                    yield r
+
+    def columns(self, fields=None):
+        """Returns the contents of the dbf file column by column: a list
+        with one list of values per field (not counting the deletion
+        flag), in the order of the fields.  Deleted records are left
+        out.  The whole record area is read and split with a few bulk
+        operations, which is much cheaper than building each row.  If
+        fields is a list of field names, only those columns are decoded
+        and returned, in that order."""
+        if not self.numRecords:
+            self.__dbfHeader()
+        self.__getFileObj(self.dbf)
+        converters = self.__recordLayout(fields)[1]
+        rows = list(self.__rawRecords(0, self.numRecords, fields))
+        if not rows:
+            return [[] for (column, convert) in converters]
+        columns = list(zip(*rows))
+        live = [flag == b(' ') for flag in columns[0]]
+        if not all(live):
+            columns = [list(itertools.compress(values, live)) for values in columns]
+        return [list(map(convert, columns[column]))
+                for (column, convert) in converters]
+
+    def shapeRecord(self, i=0, fields=None):
         """Returns a combination geometry and attribute record for the
-        supplied record index."""
+        supplied record index.  See records() for fields."""
         i = self.__restrictIndex(i)
-        return _ShapeRecord(shape=self.shape(i), record=self.record(i))
+        return _ShapeRecord(shape=self.shape(i), record=self.record(i, fields))
 
-    def shapeRecords(self):
+    def shapeRecords(self, workers=None, fields=None):
         """Returns a list of combination geometry/attribute records for
-        all records in a shapefile."""
+        all records in a shapefile.  See shapes() for workers and
+        records() for fields."""
         shapeRecords = []
         return [_ShapeRecord(shape=rec[0], record=rec[1]) \
-                                for rec in zip(self.shapes(), self.records())]
+                                for rec in zip(self.shapes(workers), self.records(fields))]
 
-    def iterShapeRecords(self):
+    def iterShapeRecords(self, bbox=None, fields=None):
         """Returns a generator of combination geometry/attribute records for
-        all records in a shapefile."""
-        for shape, record in izip(self.iterShapes(), self.iterRecords()):
+        all records in a shapefile.  If bbox is given as
+        [xmin, ymin, xmax, ymax], only the records whose shape
+        intersects it are returned, and only their geometry and
+        attributes are decoded.  See records() for fields."""
+        if bbox is not None:
+            for i, shape in self.__iterShapesIn(bbox):
+                yield _ShapeRecord(shape=shape, record=self.record(i, fields))
+            return
+        for shape, record in izip(self.iterShapes(), self.iterRecords(fields)):
             yield _ShapeRecord(shape=shape, record=record)
 
 
 class Writer:
-    """Provides write support for ESRI Shapefiles."""
-    def __init__(self, shapeType=None):
+    """Provides write support for ESRI Shapefiles.
+
+    Normally shapes and records are collected in memory and written
+    out by save().  If a target base file name, or any of the shp,
+    shx and dbf arguments (file names or file-like objects), is given
+    to the constructor, the Writer streams instead: the files are
+    opened immediately, each shape and record is written as soon as
+    it is added and is not kept, and close() fills in the file
+    headers.  Fields must be defined before the first record is
+    added to a streaming Writer.
+    """
+    def __init__(self, shapeType=None, target=None, shp=None, shx=None, dbf=None):
         self._shapes = []
         self.fields = []
         self.records = []
@@ -593,6 +1111,40 @@ class Writer:
         self._lengths = []
         # Use deletion flags in dbf? Default is false (0).
         self.deletionFlag = 0
+        self.streaming = False
+        if target or shp or shx or dbf:
+            self.__open(target, shp, shx, dbf)
+
+    def __open(self, target, shp, shx, dbf):
+        """Opens the targets of a streaming Writer and reserves space for
+        the .shp and .shx headers."""
+        if target:
+            base = os.path.splitext(target)[0]
+            shp = shp or base + '.shp'
+            shx = shx or base + '.shx'
+            dbf = dbf or base + '.dbf'
+        self.streaming = True
+        # Files opened here by name, and so closed again by close()
+        self.__ownFiles = []
+        for ext, target in (("shp", shp), ("shx", shx), ("dbf", dbf)):
+            if target:
+                f = self.__getFileObj(target)
+                if f is not target:
+                    self.__ownFiles.append(f)
+                setattr(self, ext, f)
+        for f in (self.shp, self.shx):
+            if f:
+                f.seek(0)
+                f.write(b('\0') * 100)
+        self.__numShapes = 0
+        self.__numRecords = 0
+        self.__shpLength = 100
+        self.__dbfStarted = False
+        self.__closed = False
+        # Running extents of everything written so far
+        self.__extents = None
+        self.__zExtents = None
+        self.__mExtents = [0, 0]
 
     def __getFileObj(self, f):
         """Safety handler to verify file-like objects"""
@@ -608,6 +1160,8 @@ class Writer:
 
     def __shpFileLength(self):
         """Calculates the file length of the shp file."""
+        if self.streaming:
+            return self.__shpLength // 2
         # Start with header length
         size = 100
         # Calculate size of all shapes
@@ -621,7 +1175,7 @@ class Writer:
             if hasattr(s,'parts'):
                 nParts = len(s.parts)
             if hasattr(s,'points'):
-                nPoints = len(s.points)
+                nPoints = len(_flatCoords(s.points)) // 2
             # All shape types capable of having a bounding box
             if self.shapeType in (3,5,8,13,15,18,23,25,28,31):
                 size += 32
@@ -666,20 +1220,19 @@ class Writer:
         return size
 
     def __bbox(self, shapes, shapeTypes=[]):
-        x = []
-        y = []
-        for s in shapes:
-            shapeType = self.shapeType
-            if shapeTypes:
-                shapeType = shapeTypes[shapes.index(s)]
-            px, py = list(zip(*s.points))[:2]
-            x.extend(px)
-            y.extend(py)
-        return [min(x), min(y), max(x), max(y)]
+        boxes = [_flatBbox(_flatCoords(s.points)) for s in shapes if len(s.points)]
+        if not boxes:
+            return [0, 0, 0, 0]
+        (x0, y0, x1, y1) = zip(*boxes)
+        return [min(x0), min(y0), max(x1), max(y1)]
 
     def __zbox(self, shapes, shapeTypes=[]):
         z = []
         for s in shapes:
+            if _isFlat(s.points):
+                # Flat coordinates only carry x and y
+                z.extend(getattr(s, "z", []))
+                continue
             try:
                 for p in s.points:
                     z.append(p[2])
@@ -691,6 +1244,9 @@ class Writer:
     def __mbox(self, shapes, shapeTypes=[]):
         m = [0]
         for s in shapes:
+            if _isFlat(s.points):
+                m.extend(v for v in getattr(s, "m", []) if v is not None)
+                continue
             try:
                 for p in s.points:
                     m.append(p[3])
@@ -702,16 +1258,49 @@ class Writer:
         """Returns the current bounding box for the shapefile which is
         the lower-left and upper-right corners. It does not contain the
         elevation or measure extremes."""
+        if self.streaming:
+            return self.__extents or [0, 0, 0, 0]
         return self.__bbox(self._shapes)
 
     def zbox(self):
         """Returns the current z extremes for the shapefile."""
+        if self.streaming:
+            return self.__zExtents or [0, 0]
         return self.__zbox(self._shapes)
 
     def mbox(self):
         """Returns the current m extremes for the shapefile."""
+        if self.streaming:
+            return self.__mExtents
         return self.__mbox(self._shapes)
 
+    def __extend(self, s):
+        """Adds a shape written by a streaming Writer to the running
+        extents."""
+        if not len(s.points):
+            return
+        def union(a, b):
+            if a is None:
+                return b
+            n = len(b) // 2
+            return [min(a[i], b[i]) for i in range(n)] + \
+                   [max(a[i], b[i]) for i in range(n, 2 * n)]
+        self.__extents = union(self.__extents, self.__bbox([s]))
+        self.__zExtents = union(self.__zExtents, self.__zbox([s]))
+        self.__mExtents = union(self.__mExtents, self.__mbox([s]))
+
+    def __shapeCount(self):
+        """Returns the number of shapes added so far."""
+        if self.streaming:
+            return self.__numShapes
+        return len(self._shapes)
+
+    def __recordCount(self):
+        """Returns the number of records added so far."""
+        if self.streaming:
+            return self.__numRecords
+        return len(self.records)
+
     def __shapefileHeader(self, fileObj, headerType='shp'):
         """Writes the specified header type to the specified file-like object.
         Several of the shapefile formats are so similar that a single generic
@@ -724,7 +1313,7 @@ class Writer:
         if headerType == 'shp':
             f.write(pack(">i", self.__shpFileLength()))
         elif headerType == 'shx':
-            f.write(pack('>i', ((100 + (len(self._shapes) * 8)) // 2)))
+            f.write(pack('>i', ((100 + (self.__shapeCount() * 8)) // 2)))
         # Version, Shape type
         f.write(pack("<2i", 1000, self.shapeType))
         # The shapefile's bounding box (lower left, upper right)
@@ -755,7 +1344,7 @@ class Writer:
         for field in self.fields:
             if field[0].startswith("Deletion"):
                 self.fields.remove(field)
-        numRecs = len(self.records)
+        numRecs = self.__recordCount()
         numFields = len(self.fields)
         headerLength = numFields * 32 + 33
         recordLength = sum([int(field[2]) for field in self.fields]) + 1
@@ -781,115 +1370,134 @@ class Writer:
         f.seek(100)
         recNum = 1
         for s in self._shapes:
-            self._offsets.append(f.tell())
-            # Record number, Content length place holder
-            f.write(pack(">2i", recNum, 0))
+            (offset, length) = self.__shpRecord(f, s, recNum)
+            self._offsets.append(offset)
+            self._lengths.append(length)
             recNum += 1
-            start = f.tell()
-            # Shape Type
-            if self.shapeType != 31:
-                s.shapeType = self.shapeType
-            f.write(pack("<i", s.shapeType))
-            # All shape types capable of having a bounding box
-            if s.shapeType in (3,5,8,13,15,18,23,25,28,31):
-                try:
-                    f.write(pack("<4d", *self.__bbox([s])))
-                except error:
-                    raise ShapefileException("Falied to write bounding box for record %s. Expected floats." % recNum)
-            # Shape types with parts
-            if s.shapeType in (3,5,13,15,23,25,31):
-                # Number of parts
-                f.write(pack("<i", len(s.parts)))
-            # Shape types with multiple points per record
-            if s.shapeType in (3,5,8,13,15,23,25,31):
-                # Number of points
-                f.write(pack("<i", len(s.points)))
-            # Write part indexes
-            if s.shapeType in (3,5,13,15,23,25,31):
-                for p in s.parts:
-                    f.write(pack("<i", p))
-            # Part types for Multipatch (31)
-            if s.shapeType == 31:
-                for pt in s.partTypes:
-                    f.write(pack("<i", pt))
-            # Write points for multiple-point records
-            if s.shapeType in (3,5,8,13,15,23,25,31):
-                try:
-                    [f.write(pack("<2d", *p[:2])) for p in s.points]
-                except error:
-                    raise ShapefileException("Failed to write points for record %s. Expected floats." % recNum)
-            # Write z extremes and values
-            if s.shapeType in (13,15,18,31):
-                try:
-                    f.write(pack("<2d", *self.__zbox([s])))
-                except error:
-                    raise ShapefileException("Failed to write elevation extremes for record %s. Expected floats." % recNum)
+
+    def __shpRecord(self, out, s, recNum):
+        """Writes one shp record at the current position of out, and
+        returns its offset and its content length in 16-bit words.  The
+        record content is assembled in memory first so that its length
+        is known before the record header is written, and the parts,
+        points and z and m values are each packed with one operation."""
+        offset = out.tell()
+        f = io.BytesIO()
+        # Shape Type
+        if self.shapeType != 31:
+            s.shapeType = self.shapeType
+        f.write(pack("<i", s.shapeType))
+        coords = None
+        if s.shapeType in (3,5,8,13,15,18,23,25,28,31):
+            coords = _flatCoords(s.points)
+        # All shape types capable of having a bounding box
+        if s.shapeType in (3,5,8,13,15,18,23,25,28,31):
+            try:
+                f.write(pack("<4d", *_flatBbox(coords)))
+            except (error, TypeError, ValueError):
+                raise ShapefileException("Falied to write bounding box for record %s. Expected floats." % recNum)
+        # Shape types with parts
+        if s.shapeType in (3,5,13,15,23,25,31):
+            # Number of parts
+            f.write(pack("<i", len(s.parts)))
+        # Shape types with multiple points per record
+        if s.shapeType in (3,5,8,13,15,23,25,31):
+            # Number of points
+            f.write(pack("<i", len(coords) // 2))
+        # Write part indexes
+        if s.shapeType in (3,5,13,15,23,25,31):
+            f.write(_packArray('i', s.parts))
+        # Part types for Multipatch (31)
+        if s.shapeType == 31:
+            f.write(_packArray('i', s.partTypes))
+        # Write points for multiple-point records
+        if s.shapeType in (3,5,8,13,15,23,25,31):
+            try:
+                f.write(_packArray('d', coords))
+            except (TypeError, ValueError):
+                raise ShapefileException("Failed to write points for record %s. Expected floats." % recNum)
+        # Write z extremes and values
+        if s.shapeType in (13,15,18,31):
+            try:
+                f.write(pack("<2d", *self.__zbox([s])))
+            except error:
+                raise ShapefileException("Failed to write elevation extremes for record %s. Expected floats." % recNum)
+            try:
+                if hasattr(s,"z"):
+                    f.write(_packArray('d', s.z))
+                elif _isFlat(s.points):
+                    f.write(_packArray('d', [0.0] * (len(coords) // 2)))
+                else:
+                    f.write(_packArray('d', [p[2] for p in s.points]))
+            except (TypeError, ValueError, IndexError):
+                raise ShapefileException("Failed to write elevation values for record %s. Expected floats." % recNum)
+        # Write m extremes and values
+        if s.shapeType in (13,15,18,23,25,28,31):
+            # A flat shape's m is one value per point (None for no data,
+            # as the Reader returns it), so its extremes come from __mbox.
+            flat = _isFlat(s.points)
+            try:
+                if hasattr(s,"m") and not flat:
+                    f.write(pack("<%sd" % len(s.m), *s.m))
+                else:
+                    f.write(pack("<2d", *self.__mbox([s])))
+            except error:
+                raise ShapefileException("Failed to write measure extremes for record %s. Expected floats" % recNum)
+            try:
+                if flat and hasattr(s,"m"):
+                    if len(s.m) != len(coords) // 2:
+                        raise ValueError("one measure per point expected")
+                    f.write(_packArray('d', [-10e38 if m is None else m for m in s.m]))
+                elif flat:
+                    f.write(_packArray('d', [0.0] * (len(coords) // 2)))
+                else:
+                    f.write(_packArray('d', [p[3] for p in s.points]))
+            except (TypeError, ValueError, IndexError):
+                raise ShapefileException("Failed to write measure values for record %s. Expected floats" % recNum)
+        # Write a single point
+        if s.shapeType in (1,11,21):
+            try:
+                f.write(pack("<2d", s.points[0][0], s.points[0][1]))
+            except error:
+                raise ShapefileException("Failed to write point for record %s. Expected floats." % recNum)
+        # Write a single Z value
+        if s.shapeType == 11:
+            if hasattr(s, "z"):
                 try:
-                    if hasattr(s,"z"):
-                        f.write(pack("<%sd" % len(s.z), *s.z))
-                    else:
-                        [f.write(pack("<d", p[2])) for p in s.points]  
+                    if not s.z:
+                        s.z = (0,)    
+                    f.write(pack("<d", s.z[0]))
                 except error:
-                    raise ShapefileException("Failed to write elevation values for record %s. Expected floats." % recNum)
-            # Write m extremes and values
-            if s.shapeType in (13,15,18,23,25,28,31):
+                    raise ShapefileException("Failed to write elevation value for record %s. Expected floats." % recNum)
+            else:
                 try:
-                    if hasattr(s,"m"):
-                        f.write(pack("<%sd" % len(s.m), *s.m))
-                    else:
-                        f.write(pack("<2d", *self.__mbox([s])))
+                    if len(s.points[0])<3:
+                        s.points[0].append(0)
+                    f.write(pack("<d", s.points[0][2]))
                 except error:
-                    raise ShapefileException("Failed to write measure extremes for record %s. Expected floats" % recNum)
+                    raise ShapefileException("Failed to write elevation value for record %s. Expected floats." % recNum)
+        # Write a single M value
+        if s.shapeType in (11,21):
+            if hasattr(s, "m"):
                 try:
-                    [f.write(pack("<d", p[3])) for p in s.points]
+                    if not s.m:
+                        s.m = (0,) 
+                    f.write(pack("<1d", s.m[0]))
                 except error:
-                    raise ShapefileException("Failed to write measure values for record %s. Expected floats" % recNum)
-            # Write a single point
-            if s.shapeType in (1,11,21):
+                    raise ShapefileException("Failed to write measure value for record %s. Expected floats." % recNum)    
+            else:                                
                 try:
-                    f.write(pack("<2d", s.points[0][0], s.points[0][1]))
+                    if len(s.points[0])<4:
+                        s.points[0].append(0)
+                    f.write(pack("<1d", s.points[0][3]))
                 except error:
-                    raise ShapefileException("Failed to write point for record %s. Expected floats." % recNum)
-            # Write a single Z value
-            if s.shapeType == 11:
-                if hasattr(s, "z"):
-                    try:
-                        if not s.z:
-                            s.z = (0,)    
-                        f.write(pack("<d", s.z[0]))
-                    except error:
-                        raise ShapefileException("Failed to write elevation value for record %s. Expected floats." % recNum)
-                else:
-                    try:
-                        if len(s.points[0])<3:
-                            s.points[0].append(0)
-                        f.write(pack("<d", s.points[0][2]))
-                    except error:
-                        raise ShapefileException("Failed to write elevation value for record %s. Expected floats." % recNum)
-            # Write a single M value
-            if s.shapeType in (11,21):
-                if hasattr(s, "m"):
-                    try:
-                        if not s.m:
-                            s.m = (0,) 
-                        f.write(pack("<1d", s.m[0]))
-                    except error:
-                        raise ShapefileException("Failed to write measure value for record %s. Expected floats." % recNum)    
-                else:                                
-                    try:
-                        if len(s.points[0])<4:
-                            s.points[0].append(0)
-                        f.write(pack("<1d", s.points[0][3]))
-                    except error:
-                        raise ShapefileException("Failed to write measure value for record %s. Expected floats." % recNum)
-            # Finalize record length as 16-bit words
-            finish = f.tell()
-            length = (finish - start) // 2
-            self._lengths.append(length)
-            # start - 4 bytes is the content length field
-            f.seek(start-4)
-            f.write(pack(">i", length))
-            f.seek(finish)
+                    raise ShapefileException("Failed to write measure value for record %s. Expected floats." % recNum)
+        # Record number, Content length as 16-bit words
+        content = f.getvalue()
+        length = len(content) // 2
+        out.write(pack(">2i", recNum, length))
+        out.write(content)
+        return (offset, length)
 
     def __shxRecords(self):
         """Writes the shx records."""
@@ -903,33 +1511,55 @@ class Writer:
         """Writes the dbf records."""
         f = self.__getFileObj(self.dbf)
         for record in self.records:
-            if not self.fields[0][0].startswith("Deletion"):
-                f.write(b(' ')) # deletion flag
-            for (fieldName, fieldType, size, dec), value in zip(self.fields, record):
-                fieldType = fieldType.upper()
-                size = int(size)
-                if fieldType.upper() == "N":
-                    value = str(value).rjust(size)
-                elif fieldType == 'L':
-                    value = str(value)[0].upper()
-                else:
-                    value = str(value)[:size].ljust(size)
-                if len(value) != size:
-                    raise ShapefileException(
-                        "Shapefile Writer unable to pack incorrect sized value"
-                        " (size %d) into field '%s' (size %d)." % (len(value), fieldName, size))
-                value = b(value)
-                f.write(value)
+            self.__dbfRecord(f, record)
+
+    def __dbfRecord(self, f, record):
+        """Writes one dbf record."""
+        if not self.fields[0][0].startswith("Deletion"):
+            f.write(b(' ')) # deletion flag
+        for (fieldName, fieldType, size, dec), value in zip(self.fields, record):
+            fieldType = fieldType.upper()
+            size = int(size)
+            if fieldType.upper() == "N":
+                value = str(value).rjust(size)
+            elif fieldType == 'L':
+                value = str(value)[0].upper()
+            else:
+                value = str(value)[:size].ljust(size)
+            if len(value) != size:
+                raise ShapefileException(
+                    "Shapefile Writer unable to pack incorrect sized value"
+                    " (size %d) into field '%s' (size %d)." % (len(value), fieldName, size))
+            value = b(value)
+            f.write(value)
+
+    def __addShape(self, s):
+        """Keeps a new shape for save(), or writes it straight away when
+        streaming."""
+        if not self.streaming:
+            self._shapes.append(s)
+            return
+        if not self.shapeType:
+            self.shapeType = s.shapeType
+        self.__numShapes += 1
+        if self.shp:
+            self.shp.seek(self.__shpLength)
+            (offset, length) = self.__shpRecord(self.shp, s, self.__numShapes)
+            self.__shpLength = offset + 8 + 2 * length
+            if self.shx:
+                self.shx.write(pack(">2i", offset // 2, length))
+        if s.shapeType != NULL:
+            self.__extend(s)
 
     def null(self):
         """Creates a null shape."""
-        self._shapes.append(_Shape(NULL))
+        self.__addShape(_Shape(NULL))
 
     def point(self, x, y, z=0, m=0):
         """Creates a point shape."""
         pointShape = _Shape(self.shapeType)
         pointShape.points.append([x, y, z, m])
-        self._shapes.append(pointShape)
+        self.__addShape(pointShape)
 
     def line(self, parts=[], shapeType=POLYLINE):
         """Creates a line shape. This method is just a convienience method
@@ -966,7 +1596,21 @@ class Writer:
                 for part in parts:
                     partTypes.append(polyShape.shapeType)
             polyShape.partTypes = partTypes
-        self._shapes.append(polyShape)
+        self.__addShape(polyShape)
+
+    def flatPoly(self, points, parts=None, shapeType=POLYGON):
+        """Creates a shape with multiple parts from a flat sequence of
+        interleaved x and y values (an array('d') or a NumPy array, or an
+        (n, 2) NumPy array) and the point offsets at which each part
+        starts, defaulting to a single part.  This is the layout returned
+        by Reader(..., flat=True).  The coordinates are written as they
+        are, so polygon parts must already be closed."""
+        polyShape = _Shape(shapeType)
+        polyShape.points = _flatCoords(points)
+        polyShape.parts = list(parts) if parts is not None else [0]
+        if shapeType == 31:
+            polyShape.partTypes = [shapeType] * len(polyShape.parts)
+        self.__addShape(polyShape)
 
     def field(self, name, fieldType="C", size="50", decimal=0):
         """Adds a dbf field descriptor to the shapefile."""
@@ -995,15 +1639,43 @@ class Writer:
                     else:
                         record.append(val)
         if record:
-            self.records.append(record)
+            if not self.streaming:
+                self.records.append(record)
+            elif self.dbf:
+                if not self.__dbfStarted:
+                    self.__dbfHeader()
+                    self.__dbfStarted = True
+                self.__dbfRecord(self.dbf, record)
+                self.__numRecords += 1
 
     def shape(self, i):
         return self._shapes[i]
 
     def shapes(self):
-        """Return the current list of shapes."""
+        """Return the current list of shapes.  A streaming Writer does
+        not keep its shapes, so this is always empty for one."""
         return self._shapes
 
+    def close(self):
+        """Finishes a streaming Writer: writes the file headers, which
+        need the final counts, lengths and extents, and closes the files
+        that the Writer opened itself."""
+        if not self.streaming or self.__closed:
+            return
+        if self.shp:
+            self.__shapefileHeader(self.shp, headerType='shp')
+            self.shp.seek(self.__shpLength)
+        if self.shx:
+            self.__shapefileHeader(self.shx, headerType='shx')
+            self.shx.seek(0, 2)
+        if self.dbf:
+            # Rewrite the header with the final record count
+            self.__dbfHeader()
+            self.dbf.seek(0, 2)
+        for f in self.__ownFiles:
+            f.close()
+        self.__closed = True
+
     def saveShp(self, target):
         """Save an shp file."""
         if not hasattr(target, "write"):
@@ -15,11 +15,26 @@
 
 import os
 import sys
-import zipfile
-import tempfile
-import shutil
 import json
 import struct
+import array
+import math
+import time
+import hashlib
+import pickle
+import tempfile
+import contextlib
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from optparse import OptionParser
 
@@ -27,226 +42,1347 @@ BASEDIR = os.path.dirname(os.path.realpath(__file__))
 SHAPEFILE_ZIP = os.path.join(os.path.dirname(BASEDIR),
                              "tzmap", 
                              "tz_world_mp.zip")
+SHAPEFILE_MEMBER = "world/tz_world_mp"
 
 sys.path.append(os.path.join(BASEDIR, "pyshp"))
 import shapefile
 
-op = OptionParser()
-(options, args) = op.parse_args()
-
-if len(args) != 2:
-    op.error("expected two arguments but got {0}".format(len(args)))
-jsonFilename = args[0]
-dataFilename = args[1]
-
-# The shapefile code requires files as input rather than file-like
-# objects (easily fixable) and it also requires that they be seekable,
-# which zip's file like objects are not.  So extract the files we need
-# to a temporary location.
-zf = zipfile.ZipFile(SHAPEFILE_ZIP, "r")
-tmpdir = tempfile.mkdtemp(prefix="shp")
-for f in [ "tz_world_mp.shp", "tz_world_mp.shx", "tz_world_mp.dbf" ]:
-    zf.extract("world/" + f, tmpdir)
-zf.close()
-
-sf = shapefile.Reader(os.path.join(tmpdir, "world", "tz_world_mp"))
-
-# A map from zone id to a list of polygons, where each polygon is a list
-# of points, and each point is a list of [lon, lat].
-zonePolygons = {}
-
-for shapeRec in sf.shapeRecords():
-    tzid = shapeRec.record[0]
-    shape = shapeRec.shape
-    assert shape.shapeType == 5
-    # shape.points contains a list of 2-item (x,y) lists
-    # shape.parts contains a set of indices into points, giving the
-    #   start of each part.
-    # Start by turning these into a minimally-nicer data structure: a
-    # list of polygons, each of which is a list of points (see
-    # zonePolygons).
-    npolygons = len(shape.parts)
-    def build_points(idx):
-        min = shape.parts[idx]
-        if idx + 1 == npolygons:
-            max = len(shape.points)
+PYTHON3 = sys.version_info[0] == 3
+
+# Bump this whenever the format of what segment_topology returns (or of
+# the cached pairs) changes, so that older --cache-dir entries are not
+# used.
+CACHE_VERSION = 2
+
+# How many doubles of world-map.data are buffered before each write.
+DATA_BLOCK = 64 * 1024
+
+# With --quantize, world-map.data starts with this header: the magic
+# number, the number of points, and the size of the grid the
+# coordinates are rounded to.  Then, for each point, come the changes
+# in its longitude and latitude from the previous point (in units of
+# that size), as zigzag-encoded varints.  Otherwise, world-map.data is
+# just the lon, lat values as little-endian doubles.
+DATA_MAGIC = b"TZMQ"
+DATA_HEADER = struct.Struct("<4sId")
+
+# world-map.index (--index) holds what world-map.json does, as arrays
+# that can be used in place: this header (the magic number, the format
+# version, and the numbers of zones, polygons, and chain references and
+# the length of the names), then the bounding box of each zone and of
+# each polygon as doubles, the index of each zone's first polygon and of
+# each polygon's first chain (each with one more entry at the end) as
+# uint32s, the start and end of each chain as int32s, and the zone names
+# in UTF-8, separated by newlines.  Everything is little-endian, and
+# the zones are sorted by name.
+INDEX_MAGIC = b"TZMI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIIIII")
+
+@contextlib.contextmanager
+def timed(phases, name):
+    """Appends the wall and CPU time taken by the body of the with
+    statement to the list phases, as {"phase": name, "wall": seconds,
+    "cpu": seconds, "childrenCpu": seconds}, where childrenCpu is the
+    time used by worker processes that finished during the phase."""
+    wall = time.time()
+    before = os.times()
+    try:
+        yield
+    finally:
+        after = os.times()
+        phases.append({ "phase": name,
+                        "wall": time.time() - wall,
+                        "cpu": (after[0] + after[1]) - (before[0] + before[1]),
+                        "childrenCpu": (after[2] + after[3]) -
+                                       (before[2] + before[3]) })
+
+def peak_rss():
+    """Returns the peak resident set size, in bytes, of this process and
+    of its largest finished child process, or Nones where the platform
+    can't tell."""
+    if resource is None:
+        return (None, None)
+    # ru_maxrss is in bytes on Mac OS X, but kilobytes elsewhere.
+    unit = 1 if sys.platform == "darwin" else 1024
+    return tuple(resource.getrusage(who).ru_maxrss * unit
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+# A map from zone id to a list of polygons, where each polygon is a dict
+# whose "points" are a flat sequence of lon, lat, lon, lat, ... values.
+# The topology functions below add "firstEdge" and "numEdges".
+def read_zones(jobs, shapefileName=SHAPEFILE_ZIP, member=SHAPEFILE_MEMBER):
+    # Read the shapefile straight out of the zip; the Reader buffers each
+    # member itself, so nothing needs to be extracted to disk.  Any other
+    # shapefileName is the name of the shapefile itself.
+    if os.path.splitext(shapefileName)[1].lower() == ".zip":
+        sf = shapefile.Reader(shapefileName, member, mmap=True, flat=True)
+    else:
+        sf = shapefile.Reader(shapefileName, mmap=True, flat=True)
+
+    zonePolygons = {}
+
+    for shapeRec in sf.shapeRecords(workers=jobs, fields=["TZID"]):
+        tzid = shapeRec.record[0]
+        shape = shapeRec.shape
+        assert shape.shapeType == 5
+        # shape.points contains a flat sequence of x,y values
+        # shape.parts contains a set of point indices into points, giving
+        #   the start of each part.
+        # Start by turning these into a minimally-nicer data structure: a
+        # list of polygons, each of which is a flat list of coordinates (see
+        # zonePolygons).
+        npolygons = len(shape.parts)
+        def build_points(idx):
+            min = shape.parts[idx]
+            if idx + 1 == npolygons:
+                max = len(shape.points) // 2
+            else:
+                max = shape.parts[idx + 1]
+            return shape.points[2 * min:2 * max]
+        zonePolygons[tzid] = [ { "points": build_points(idx) } for idx in range(npolygons)]
+
+    # Uncomment to test with just four timezones:
+    #zonePolygons = { tz:zonePolygons[tz] for tz in zonePolygons if tz[0:9] == "America/L" }
+
+    return zonePolygons
+
+def split_overlaps(zonePolygons, tolerance):
+    """Splits every edge at the polygon points (of any polygon) that lie
+    on it, within tolerance degrees, so that when one polygon's edge
+    runs along part of another's, the overlapping part becomes a
+    segment of both.  Candidate edges for each point are found with a
+    grid index over the cells each edge passes through."""
+    polygons = [polygon for polygons in zonePolygons.values()
+                        for polygon in polygons]
+    polygonCoords = [polygon["points"].tolist() for polygon in polygons]
+    # Each edge is (polygon index, point index of its start).
+    edges = []
+    extent = 0.0
+    for (p, coords) in enumerate(polygonCoords):
+        for i in range(0, len(coords) - 2, 2):
+            edges.append((p, i))
+            dx = abs(coords[i + 2] - coords[i])
+            if dx > 180:
+                dx = 360 - dx
+            extent += max(dx, abs(coords[i + 3] - coords[i + 1]))
+    if not edges:
+        return
+    cellSize = max(extent / len(edges), 16 * tolerance, 1e-9)
+
+    # Each grid cell holds (x0, y0, x1, y1, edge) for the edges that
+    # pass within the tolerance of it.  An edge spanning more than 180
+    # degrees of longitude crosses the date line (as in polygon_bbox and
+    # tzmap.js), so it goes in twice, with its longitudes made
+    # continuous past 180 and past -180, to meet the points on either
+    # side of the date line.  Adding an edge to every cell of its
+    # bounding box would make one long diagonal edge fill a square of
+    # cells, so each edge is walked a column of cells at a time, adding
+    # it only to the cells of that column that the part of it crossing
+    # the column (grown by the tolerance) touches.  The extra 1e-12
+    # covers rounding in the interpolation.
+    grid = {}
+    pad = tolerance + 1e-12
+    for (e, (p, i)) in enumerate(edges):
+        (x0, y0, x1, y1) = polygonCoords[p][i:i + 4]
+        if abs(x1 - x0) > 180:
+            if x0 < x1:
+                x0 += 360
+            else:
+                x1 += 360
+            placements = [(x0, y0, x1, y1), (x0 - 360, y0, x1 - 360, y1)]
         else:
-            max = shape.parts[idx + 1]
-        return shape.points[min:max]
-    zonePolygons[tzid] = [ { "points": build_points(idx) } for idx in range(npolygons)]
+            placements = [(x0, y0, x1, y1)]
+        for (x0, y0, x1, y1) in placements:
+            edge = (x0, y0, x1, y1, e)
+            if x1 < x0:
+                (x0, y0, x1, y1) = (x1, y1, x0, y0)
+            slope = (y1 - y0) / (x1 - x0) if x1 != x0 else None
+            for cx in range(int((x0 - pad) // cellSize),
+                            int((x1 + pad) // cellSize) + 1):
+                if slope is None:
+                    (ya, yb) = (y0, y1)
+                else:
+                    ya = y0 + (max(x0, cx * cellSize - pad) - x0) * slope
+                    yb = y0 + (min(x1, (cx + 1) * cellSize + pad) - x0) * slope
+                for cy in range(int((min(ya, yb) - pad) // cellSize),
+                                int((max(ya, yb) + pad) // cellSize) + 1):
+                    grid.setdefault((cx, cy), []).append(edge)
 
-# Uncomment to test with just four timezones:
-#zonePolygons = { tz:zonePolygons[tz] for tz in zonePolygons if tz[0:9] == "America/L" }
+    points = set()
+    for coords in polygonCoords:
+        points.update(zip(coords[0::2], coords[1::2]))
 
-sf = None
-shutil.rmtree(tmpdir)
+    # For each edge that has points on it, a list of (position along the
+    # edge, x, y).
+    splits = {}
+    tolerance2 = tolerance * tolerance
+    for (px, py) in points:
+        for (x0, y0, x1, y1, e) in grid.get((int(px // cellSize),
+                                             int(py // cellSize)), ()):
+            dx = x1 - x0
+            dy = y1 - y0
+            length2 = dx * dx + dy * dy
+            cross = dx * (py - y0) - dy * (px - x0)
+            if cross * cross > tolerance2 * length2:
+                continue
+            # The point is close enough to the edge's line; it also has
+            # to be further than the tolerance from both of its ends.
+            t = (dx * (px - x0) + dy * (py - y0)) / length2
+            if 0 < t < 1 and t * t * length2 > tolerance2 and \
+               (1 - t) * (1 - t) * length2 > tolerance2:
+                splits.setdefault(e, []).append((t, px, py))
+
+    # Rebuild the polygons that have split edges, in one pass each.
+    polygonSplits = {}
+    for e in splits:
+        (p, i) = edges[e]
+        polygonSplits.setdefault(p, []).append((i, sorted(splits[e])))
+    for (p, edgeSplits) in polygonSplits.items():
+        coords = polygonCoords[p]
+        newCoords = array.array("d")
+        done = 0
+        for (i, edgeSplit) in sorted(edgeSplits):
+            newCoords.extend(coords[done:i + 2])
+            for (t, px, py) in edgeSplit:
+                newCoords.extend((px, py))
+            done = i + 2
+        newCoords.extend(coords[done:])
+        polygons[p]["points"] = newCoords
+    sys.stderr.write("Split {0} edges at {1} points.\n"
+                     .format(len(splits), sum(len(s) for s in splits.values())))
 
 # We want to uniquely identify segments, but let them run either
-# direction.  So given a segment that runs between [lona, lata] and
-# [lonb, latb], we need to know which points are the canonical "first"
-# points.  We define that by saying the "first" pair in the segment is
-# the one where the longitude is smaller; if the longitudes are equal
-# then it is the one where the latitude is smaller.
-# FIXME: This approach doesn't work when one segment is a subsegment of
+# direction.  To make that cheap, every distinct [lon, lat] point is
+# first interned as a small integer vertex id, and a segment is then
+# identified by the pair of its vertex ids, smaller id first, packed
+# into a single integer.  A segment whose second point sorts before its
+# first (comparing [lon, lat] pairs) is "reversed".
+# This approach doesn't work when one segment is a subsegment of
 # another.  This is most obvious on the Egypt-Libya border, where
 # merging the polygons for Egypt and Libya (which are often in the same
 # UTC offset) yields a polygon with a large zero-width indentation
-# running most of the length of their border.
-
-class LonLat:
-    def __init__(self, lon, lat):
-        self.lon = lon
-        self.lat = lat
-    # FIXME: __cmp__ no longer exists in python 3
-    def __cmp__(self, other):
-        result = cmp(self.lon, other.lon)
-        if result != 0:
-            return result
-        return cmp(self.lat, other.lat)
-    def __hash__(self):
-        return hash(self.lat) ^ hash(self.lon)
-
-class SegmentRef:
-    def __init__(self, tz, polygonidx, segidx):
-        self.tz = tz
-        self.polygonidx = polygonidx
-        self.segidx = segidx
-
-class Segment:
-    def __init__(self, a, b):
-        assert a < b
-        self.a = a
-        self.b = b
-    # FIXME: __cmp__ no longer exists in python 3
-    def __cmp__(self, other):
-        result = cmp(self.a, other.a)
-        if result != 0:
-            return result
-        return cmp(self.b, other.b)
-    def __hash__(self):
-        return hash(self.a) ^ hash(self.b)
-
-class SegmentData:
-    def __init__(self):
-        self.fwdRef = None
-        self.revRef = None
-        self.chain = None
-
-segments = {}
-
-# FIXME: This is slow!
-def find_segment(a, b):
-    assert a != b
-    is_reversed = b < a
-    if is_reversed:
-        seg = Segment(b, a)
+# running most of the length of their border.  split_overlaps (the
+# --split-overlaps option) fixes that up first.
+#
+# Each polygon gets a serial number, and the line segments making up
+# the polygons' outlines (one per consecutive pair of points, in
+# order) are numbered consecutively across all polygons.  A segment
+# reference (formerly a (tz, polygonidx, segidx) object) is just that
+# edge number.  Each topology function returns a tuple of:
+#  * edgeSegs: for each edge, 2 * segment id, plus 1 if the edge runs
+#    the segment in reverse
+#  * the number of segment ids
+#  * a function that says whether an edge (not the first of its
+#    polygon) separates the same polygons as the edge before it
+
+def polygon_edges(polygons):
+    """Sets "firstEdge" and "numEdges" on the given polygons (in serial
+    number order) and returns an array mapping each edge to the serial
+    number of its polygon."""
+    edgePolygon = array.array("i")
+    for (polygonSerial, polygon) in enumerate(polygons):
+        polygon["firstEdge"] = len(edgePolygon)
+        polygon["numEdges"] = len(polygon["points"]) // 2 - 1
+        edgePolygon.extend(array.array("i", [polygonSerial]) * polygon["numEdges"])
+    return edgePolygon
+
+def segment_topology(polygons, sharing=False):
+    """Builds up the segment data for a sequence of flat coordinate
+    arrays, which tells us for each line segment that is part of a zone
+    boundary, which zone or pair of zones uses that segment as part of
+    its boundary.  Returns edgeSegs and the edges running each segment
+    forwards and backwards (-1 if none).  If sharing is true, also
+    returns the ids and the packed [lon, lat, lon, lat] points of the
+    segments that are only run one way here, for merge_topology."""
+    vertexIds = {}
+    segments = {}
+    edgeSegs = array.array("i")
+    segFwdRef = array.array("i")
+    segRevRef = array.array("i")
+    segPoints = []
+    for coords in polygons:
+        coords = coords.tolist()
+        points = list(zip(coords[0::2], coords[1::2]))
+        ids = [vertexIds.setdefault(point, len(vertexIds)) for point in points]
+        assert ids[0] == ids[-1]
+        for segidx in range(len(ids) - 1):
+            a = ids[segidx]
+            b = ids[segidx + 1]
+            assert a != b
+            edge = len(edgeSegs)
+            if b < a:
+                seg = segments.setdefault((b << 32) | a, len(segments))
+            else:
+                seg = segments.setdefault((a << 32) | b, len(segments))
+            if seg == len(segFwdRef):
+                segFwdRef.append(-1)
+                segRevRef.append(-1)
+                if sharing:
+                    segPoints.append(min(points[segidx], points[segidx + 1]) +
+                                     max(points[segidx], points[segidx + 1]))
+            if points[segidx + 1] < points[segidx]:
+                assert segRevRef[seg] == -1
+                segRevRef[seg] = edge
+                edgeSegs.append(2 * seg + 1)
+            else:
+                assert segFwdRef[seg] == -1
+                segFwdRef[seg] = edge
+                edgeSegs.append(2 * seg)
+    if not sharing:
+        return (edgeSegs, segFwdRef, segRevRef)
+    openSegs = array.array("i")
+    openPoints = array.array("d")
+    for seg in range(len(segFwdRef)):
+        if segFwdRef[seg] == -1 or segRevRef[seg] == -1:
+            openSegs.append(seg)
+            # Adding 0.0 turns -0.0 into 0.0, so the packed points are
+            # the same exactly when the points compare equal.
+            openPoints.extend([value + 0.0 for value in segPoints[seg]])
+    if PYTHON3:
+        openPoints = openPoints.tobytes()
     else:
-        seg = Segment(a, b)
-    data = segments.setdefault(seg, SegmentData())
-    return (seg, data, is_reversed)
-
-# Build up the segment data, which tells us for each line segment that
-# is part of a zone boundary, which zone or pair of zones uses that
-# segment as part of its boundary.
-for (tz, polygons) in zonePolygons.items():
-    sys.stderr.write("Building segments for {0}.\n".format(tz))
-    for polygonidx in range(len(polygons)):
-        polygon = polygons[polygonidx]
-        lls = [LonLat(pt[0], pt[1]) for pt in polygon["points"]]
-        assert lls[0] == lls[len(lls)-1]
-        def seg_for(segidx):
-            a = lls[segidx]
-            b = lls[segidx+1]
-            (seg, segdata, is_reversed) = find_segment(a, b)
-            ref = SegmentRef(tz, polygonidx, segidx)
-            if is_reversed:
-                assert segdata.revRef is None
-                segdata.revRef = ref
+        openPoints = openPoints.tostring()
+    return (edgeSegs, segFwdRef, segRevRef, openSegs, openPoints)
+
+def _shared_segment_topology(polygons):
+    """Process pool worker for dict_topology and cached_zone_topology."""
+    return segment_topology(polygons, True)
+
+def match_segments(parts, candidates=None, changed=None):
+    """Pairs up the segments that are run one way in one result of
+    segment_topology(..., True) and the other way in a later one, by
+    their points.  Only the parts whose indices are in candidates (all
+    of them if None) are considered, and if changed is given, only pairs
+    with at least one part in it are returned.  Returns a dict mapping
+    (earlier part index, later part index) to an array of interleaved
+    (earlier part segment, later part segment) ids."""
+    if candidates is None:
+        candidates = range(len(parts))
+    openSegments = {}
+    pairs = {}
+    for i in candidates:
+        (openSegs, openPoints) = parts[i][3:5]
+        for (k, local) in enumerate(openSegs):
+            key = openPoints[32 * k:32 * k + 32]
+            first = openSegments.setdefault(key, (i, local))
+            if first[0] == i or \
+               changed is not None and first[0] not in changed and i not in changed:
+                continue
+            pairs.setdefault((first[0], i), array.array("i")).extend([first[1], local])
+    return pairs
+
+def merge_topology(parts, pairs=None):
+    """Merges the results of segment_topology(..., True) for consecutive
+    runs of polygons into edgeSegs, segFwdRef and segRevRef for all of
+    them, using pairs (see match_segments, which computes it if None)
+    to join the segments shared between parts.  The result only depends
+    on the order of the parts, not on which process produced them."""
+    if pairs is None:
+        pairs = match_segments(parts)
+    edgeSegs = array.array("i")
+    segFwdRef = array.array("i")
+    segRevRef = array.array("i")
+    segOffsets = []
+    # Each of the parts' segments gets the next id, and the segments
+    # already seen in an earlier part are then moved onto the id they
+    # got there, leaving an unused id behind.
+    for (partEdgeSegs, partFwdRef, partRevRef) in (part[0:3] for part in parts):
+        edgeOffset = len(edgeSegs)
+        segOffset = len(segFwdRef)
+        segOffsets.append(segOffset)
+        edgeSegs.extend([edgeSeg + 2 * segOffset for edgeSeg in partEdgeSegs])
+        segFwdRef.extend([ref + edgeOffset if ref != -1 else -1
+                          for ref in partFwdRef])
+        segRevRef.extend([ref + edgeOffset if ref != -1 else -1
+                          for ref in partRevRef])
+    for (i, j) in sorted(pairs):
+        shared = pairs[(i, j)]
+        for k in range(0, len(shared), 2):
+            seg = segOffsets[i] + shared[k]
+            later = segOffsets[j] + shared[k + 1]
+            fwd = segFwdRef[later]
+            if fwd != -1:
+                assert segFwdRef[seg] == -1
+                segFwdRef[seg] = fwd
+                edgeSegs[fwd] = 2 * seg
+            rev = segRevRef[later]
+            if rev != -1:
+                assert segRevRef[seg] == -1
+                segRevRef[seg] = rev
+                edgeSegs[rev] = 2 * seg + 1
+            segFwdRef[later] = -1
+            segRevRef[later] = -1
+    return (edgeSegs, segFwdRef, segRevRef)
+
+def polygon_runs(polygons, jobs):
+    """Splits the polygons into about four consecutive runs per job,
+    balanced by number of points."""
+    numRuns = min(len(polygons), jobs * 4)
+    total = sum(len(polygon["points"]) for polygon in polygons)
+    start = 0
+    done = 0
+    for run in range(numRuns):
+        stop = start
+        target = total * (run + 1) // numRuns
+        while stop < len(polygons) and (done < target or stop == start):
+            done += len(polygons[stop]["points"])
+            stop += 1
+        if run == numRuns - 1:
+            stop = len(polygons)
+        if stop > start:
+            yield [polygon["points"] for polygon in polygons[start:stop]]
+        start = stop
+
+def _points_bytes(points):
+    if PYTHON3 or numpy is not None and isinstance(points, numpy.ndarray):
+        return points.tobytes()
+    return points.tostring()
+
+def zone_hash(polygons):
+    """Returns a hex digest of a zone's polygons' points."""
+    digest = hashlib.sha1(struct.pack("<2i", CACHE_VERSION, sys.version_info[0]))
+    for polygon in polygons:
+        digest.update(struct.pack("<i", len(polygon["points"])))
+        digest.update(_points_bytes(polygon["points"]))
+    return digest.hexdigest()
+
+def zone_bbox(polygons):
+    """Returns a zone's [west, south, east, north]."""
+    xs = [f(polygon["points"][0::2]) for polygon in polygons for f in (min, max)]
+    ys = [f(polygon["points"][1::2]) for polygon in polygons for f in (min, max)]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def cached_zone_topology(zonePolygons, cacheDir, jobs=1):
+    """Returns the result of segment_topology(..., True) for each zone,
+    in zonePolygons order, and the pairs of segments shared between
+    them, for merge_topology.  Both are kept in cacheDir under the
+    hashes of the zones' points, so only the zones whose geometry
+    changed since the last run are recomputed, and only they and the
+    zones whose bounding boxes touch theirs are searched for shared
+    segments.  The cached pairs record which zones they were found for,
+    and any zone they don't cover (say, because an earlier run was
+    interrupted after writing its segments) is searched again too.
+    Cache entries for zones that are gone are removed."""
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    zones = list(zonePolygons.values())
+    hashes = [zone_hash(polygons) for polygons in zones]
+    parts = [None] * len(hashes)
+    for (i, zoneHash) in enumerate(hashes):
+        if hashes.count(zoneHash) > 1:
+            # Don't mix up the pairs of zones with the same points.
+            continue
+        parts[i] = load_cache(os.path.join(cacheDir, zoneHash + ".edges"))
+    changed = set(i for i in range(len(parts)) if parts[i] is None)
+    sys.stderr.write("Reusing cached segments for {0} of {1} zones.\n"
+                     .format(len(parts) - len(changed), len(parts)))
+    tasks = [[polygon["points"] for polygon in zones[i]] for i in sorted(changed)]
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_shared_segment_topology, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [segment_topology(task, True) for task in tasks]
+    for (i, part) in zip(sorted(changed), results):
+        parts[i] = part
+        save_cache(os.path.join(cacheDir, hashes[i] + ".edges"), part)
+
+    # The cached pairs are kept by zone hash, the earlier hash first,
+    # along with the set of hashes of the zones they were found for.
+    cached = load_cache(os.path.join(cacheDir, "pairs"))
+    if not isinstance(cached, tuple) or len(cached) != 2:
+        cached = (set(), {})
+    (covered, cachedPairs) = cached
+    unmatched = set(i for i in range(len(parts))
+                    if i in changed or hashes[i] not in covered)
+    if len(unmatched) > len(changed):
+        sys.stderr.write("Matching the segments of {0} zones that the "
+                         "cached pairs don't cover.\n"
+                         .format(len(unmatched) - len(changed)))
+    pairs = {}
+    position = dict((zoneHash, i) for (i, zoneHash) in enumerate(hashes)
+                    if i not in unmatched)
+    for ((hashA, hashB), shared) in cachedPairs.items():
+        if hashA in position and hashB in position:
+            (i, j) = (position[hashA], position[hashB])
+            if i > j:
+                (i, j) = (j, i)
+                shared = array.array("i", shared)
+                shared[0::2], shared[1::2] = shared[1::2], shared[0::2]
+            pairs[(i, j)] = shared
+    if unmatched:
+        bboxes = [zone_bbox(polygons) for polygons in zones]
+        def touches(a, b):
+            return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+        candidates = [i for i in range(len(zones))
+                      if i in unmatched or
+                         any(touches(bboxes[i], bboxes[c]) for c in unmatched)]
+        pairs.update(match_segments(parts, candidates, unmatched))
+    cachedPairs = {}
+    for ((i, j), shared) in pairs.items():
+        if hashes[i] > hashes[j]:
+            shared = array.array("i", shared)
+            shared[0::2], shared[1::2] = shared[1::2], shared[0::2]
+            cachedPairs[(hashes[j], hashes[i])] = shared
+        else:
+            cachedPairs[(hashes[i], hashes[j])] = shared
+    # Zones with the same points as another are always matched again.
+    covered = set(zoneHash for zoneHash in hashes if hashes.count(zoneHash) == 1)
+    save_cache(os.path.join(cacheDir, "pairs"), (covered, cachedPairs))
+
+    current = set(zoneHash + ".edges" for zoneHash in hashes)
+    for name in os.listdir(cacheDir):
+        if name.endswith(".edges") and name not in current:
+            os.remove(os.path.join(cacheDir, name))
+    return (parts, pairs)
+
+def load_cache(cacheName):
+    """Returns what save_cache stored as cacheName, or None."""
+    try:
+        cacheIO = open(cacheName, "rb")
+    except IOError:
+        return None
+    try:
+        return pickle.load(cacheIO)
+    except (EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    finally:
+        cacheIO.close()
+
+def save_cache(cacheName, value):
+    # Write under a temporary name first so that an interrupted run
+    # never leaves a truncated entry behind.
+    cacheIO = open(cacheName + ".tmp", "wb")
+    pickle.dump(value, cacheIO, pickle.HIGHEST_PROTOCOL)
+    cacheIO.close()
+    if os.path.exists(cacheName):
+        os.remove(cacheName)
+    os.rename(cacheName + ".tmp", cacheName)
+
+def dict_topology(polygons, jobs=1, parts=None, pairs=None):
+    """Computes the topology one edge at a time, with a dict of
+    segments, in jobs processes.  If parts is given, it is the result
+    of segment_topology(..., True) for consecutive runs of the
+    polygons, and only needs to be merged (see merge_topology)."""
+    edgePolygon = polygon_edges(polygons)
+    if parts is not None:
+        (edgeSegs, segFwdRef, segRevRef) = merge_topology(parts, pairs)
+    elif jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            (edgeSegs, segFwdRef, segRevRef) = merge_topology(
+                pool.map(_shared_segment_topology,
+                         list(polygon_runs(polygons, jobs))))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        (edgeSegs, segFwdRef, segRevRef) = \
+            segment_topology([polygon["points"] for polygon in polygons])
+
+    # A polygon's last edge is followed by its first.
+    def refs_in_sequence(refa, refb):
+        if refa == -1 or refb == -1:
+            return refa == -1 and refb == -1
+        if edgePolygon[refa] != edgePolygon[refb]:
+            return False
+        if abs(refa - refb) == 1:
+            return True
+        polygon = polygons[edgePolygon[refa]]
+        return (min(refa, refb), max(refa, refb)) == \
+               (polygon["firstEdge"],
+                polygon["firstEdge"] + polygon["numEdges"] - 1)
+    def edge_in_sequence(edge):
+        polygon = polygons[edgePolygon[edge]]
+        if edge == polygon["firstEdge"]:
+            sega = edgeSegs[edge + polygon["numEdges"] - 1] >> 1
+        else:
+            sega = edgeSegs[edge - 1] >> 1
+        segb = edgeSegs[edge] >> 1
+        if refs_in_sequence(segFwdRef[sega], segFwdRef[segb]) and \
+           refs_in_sequence(segRevRef[sega], segRevRef[segb]):
+             return True
+        if refs_in_sequence(segFwdRef[sega], segRevRef[segb]) and \
+           refs_in_sequence(segRevRef[sega], segFwdRef[segb]):
+             return True
+        return False
+    return (edgeSegs, len(segFwdRef), edge_in_sequence)
+
+def sorted_topology(polygons):
+    """Computes the topology with a few sorts over arrays holding every
+    edge, rather than one edge at a time."""
+    lengths = numpy.array([len(p["points"]) // 2 for p in polygons],
+                          dtype=numpy.int64)
+    points = numpy.concatenate([numpy.asarray(p["points"], dtype=numpy.float64)
+                                for p in polygons])
+    # Intern the points as vertex ids, numbered in [lon, lat] order.
+    # Adding 0.0 turns -0.0 into 0.0, so that two points have the same
+    # bits exactly when they compare equal.
+    points = points.reshape(-1, 2) + 0.0
+    bits = points.view(numpy.int64)
+    order = numpy.lexsort((points[:, 1], points[:, 0]))
+    sortedBits = bits[order]
+    newVertex = numpy.ones(len(order), dtype=bool)
+    newVertex[1:] = (sortedBits[1:] != sortedBits[:-1]).any(axis=1)
+    vertex = numpy.empty(len(order), dtype=numpy.int64)
+    vertex[order] = numpy.cumsum(newVertex) - 1
+    numVertices = int(vertex.max()) + 1
+    sortedBits = bits = points = None
+
+    ends = numpy.cumsum(lengths)
+    assert (vertex[ends - lengths] == vertex[ends - 1]).all()
+    isEdge = numpy.ones(len(vertex), dtype=bool)
+    isEdge[ends - 1] = False
+    edgeStarts = numpy.nonzero(isEdge)[0]
+    a = vertex[edgeStarts]
+    b = vertex[edgeStarts + 1]
+    assert (a != b).all()
+    numEdges = lengths - 1
+    firstEdges = numpy.cumsum(numEdges) - numEdges
+    for (polygon, firstEdge, count) in zip(polygons, firstEdges.tolist(),
+                                           numEdges.tolist()):
+        polygon["firstEdge"] = firstEdge
+        polygon["numEdges"] = count
+
+    # Canonicalize the direction of every edge, and give each distinct
+    # (smaller vertex id, larger vertex id) pair a segment id.
+    reverse = b < a
+    keys = numpy.minimum(a, b) * numVertices + numpy.maximum(a, b)
+    (segKeys, seg) = numpy.unique(keys, return_inverse=True)
+    seg = seg.reshape(-1)
+    numSegments = len(segKeys)
+    edge = numpy.arange(len(seg))
+    edgePolygon = numpy.repeat(numpy.arange(len(polygons)), numEdges)
+
+    # Each segment is run at most once in each direction.
+    refs = []
+    for direction in (~reverse, reverse):
+        assert (numpy.bincount(seg[direction], minlength=numSegments) <= 1).all()
+        ref = numpy.full(numSegments, -1, dtype=numpy.int64)
+        ref[seg[direction]] = edge[direction]
+        refs.append(ref)
+    (segFwdRef, segRevRef) = refs
+
+    # A polygon's last edge is followed by its first.
+    lastEdges = firstEdges + numEdges - 1
+    def refs_in_sequence(refa, refb):
+        both = (refa != -1) & (refb != -1)
+        a = numpy.where(both, refa, 0)
+        b = numpy.where(both, refb, 0)
+        p = edgePolygon[a]
+        return numpy.where(both,
+                           (p == edgePolygon[b]) &
+                           ((numpy.abs(a - b) == 1) |
+                            ((numpy.minimum(a, b) == firstEdges[p]) &
+                             (numpy.maximum(a, b) == lastEdges[p]))),
+                           (refa == -1) & (refb == -1))
+    prevEdge = edge - 1
+    prevEdge[firstEdges] = lastEdges
+    fwda = segFwdRef[seg[prevEdge]]
+    reva = segRevRef[seg[prevEdge]]
+    fwdb = segFwdRef[seg]
+    revb = segRevRef[seg]
+    inSequence = (refs_in_sequence(fwda, fwdb) &
+                  refs_in_sequence(reva, revb)) | \
+                 (refs_in_sequence(fwda, revb) &
+                  refs_in_sequence(reva, fwdb))
+
+    return ((2 * seg + reverse).tolist(), numSegments,
+            inSequence.tolist().__getitem__)
+
+def quantized_encoder(scale):
+    """Returns a function that encodes a flat sequence of lon, lat values
+    in the --quantize format (without the header), carrying on from the
+    values passed to the previous call."""
+    previous = [0, 0]
+    def encode(values):
+        out = bytearray()
+        for (i, value) in enumerate(values):
+            q = int(math.floor(value / scale + 0.5))
+            delta = q - previous[i % 2]
+            previous[i % 2] = q
+            if delta >= 0:
+                v = delta * 2
             else:
-                assert segdata.fwdRef is None
-                segdata.fwdRef = ref
-            return (seg, segdata, is_reversed)
-        polygon["segs"] = [seg_for(segidx) for segidx in range(len(lls)-1)]
-
-# Build up as-maximal-as-is-easy (i.e., we still break at the start/end
-# of the original points list for the polygon) chains of line segments
-# that separate the same pair of time zones.  (I'd have called them
-# sequences, but then I'd have to distinguish "seg" and "seq".)
-chains = []
-dataIO = open(dataFilename, "w")
-dataIndex = 0
-def refs_in_sequence(refa, refb):
-    if refa is None or refb is None:
-        return refa is None and refb is None
-    return refa.tz == refb.tz and \
-           refa.polygonidx == refb.polygonidx and \
-           abs(refa.segidx - refb.segidx) == 1
-def segments_in_sequence(segdataa, segdatab):
-    if refs_in_sequence(segdataa.fwdRef, segdatab.fwdRef) and \
-       refs_in_sequence(segdataa.revRef, segdatab.revRef):
-         return True
-    if refs_in_sequence(segdataa.fwdRef, segdatab.revRef) and \
-       refs_in_sequence(segdataa.revRef, segdatab.fwdRef):
-         return True
-    return False
-for (tz, polygons) in zonePolygons.items():
-    sys.stderr.write("Writing segments for {0}.\n".format(tz))
-    for polygonidx in range(len(polygons)):
-        polygon = polygons[polygonidx]
-        segs = polygon["segs"]
-        polygon["chains"] = polygonChains = []
-        currentChainID = None
-        currentChainData = None
-        for segidx in range(len(segs)):
-            (seg, segdata, is_reversed) = segs[segidx]
-            if segdata.chain is None:
-                # We're responsible for writing this segment
-                continueChain = False
-                if segidx != 0:
-                    (prevseg, prevsegdata, prev_is_reversed) = segs[segidx-1]
-                    if segments_in_sequence(prevsegdata, segdata) and \
-                       (segdata.chain is None) == (currentChainData is not None):
-                        continueChain = True
-                if continueChain:
-                    currentChainData[1] = currentChainData[1] + 1
-                    dataIndex = dataIndex + 1
-                    assert dataIndex == currentChainData[1]
-                    if is_reversed:
-                        dataIO.write(struct.pack("<2d", seg.a.lon, seg.a.lat))
-                    else:
-                        dataIO.write(struct.pack("<2d", seg.b.lon, seg.b.lat))
-                else:
-                    currentChainID = len(chains)
-                    startIndex = dataIndex
-                    dataIndex = dataIndex + 2
-                    endIndex = dataIndex
-                    [p0, p1] = [None, None]
-                    if is_reversed:
-                        [p0, p1] = [ seg.b, seg.a ]
+                v = -delta * 2 - 1
+            while v >= 0x80:
+                out.append((v & 0x7f) | 0x80)
+                v >>= 7
+            out.append(v)
+        return bytes(out)
+    return encode
+
+def write_points(dataFilename, points, scale=None):
+    """Writes a flat array('d') of lon, lat values as world-map.data,
+    quantized to scale if given."""
+    dataIO = open(dataFilename, "wb")
+    try:
+        if scale is not None:
+            dataIO.write(DATA_HEADER.pack(DATA_MAGIC, len(points) // 2, scale))
+            dataIO.write(quantized_encoder(scale)(points))
+        else:
+            if sys.byteorder == "big":
+                points = array.array("d", points)
+                points.byteswap()
+            points.tofile(dataIO)
+    finally:
+        dataIO.close()
+
+def read_points(dataFilename):
+    """Returns the points of world-map.data, in either format, as a flat
+    array('d') of lon, lat values."""
+    points = array.array("d")
+    dataIO = open(dataFilename, "rb")
+    try:
+        header = dataIO.read(DATA_HEADER.size)
+        if header[:len(DATA_MAGIC)] != DATA_MAGIC:
+            dataIO.seek(0)
+            points.fromfile(dataIO, os.path.getsize(dataFilename) // 8)
+            if sys.byteorder == "big":
+                points.byteswap()
+            return points
+        (magic, count, scale) = DATA_HEADER.unpack(header)
+        data = bytearray(dataIO.read())
+    finally:
+        dataIO.close()
+    previous = [0, 0]
+    v = 0
+    shift = 0
+    for b in data:
+        v |= (b & 0x7f) << shift
+        shift += 7
+        if b & 0x80:
+            continue
+        if v & 1:
+            v = -((v + 1) >> 1)
+        else:
+            v >>= 1
+        i = len(points) % 2
+        previous[i] += v
+        points.append(previous[i] * scale)
+        v = 0
+        shift = 0
+    assert len(points) == 2 * count
+    return points
+
+def write_chains(zonePolygons, topology, dataFilename, scale=None,
+                 counts=None):
+    """Writes the points of the chains to dataFilename (quantized to
+    scale if given), and yields (tz, the chains of each of its polygons)
+    as each zone is finished.  If counts is given, the numbers of
+    chains, references to them, and points written are stored in it
+    once all the zones are done."""
+    (edgeSegs, numSegments, edge_in_sequence) = topology
+    # The chain each segment was written to (-1 until it has been).
+    segChain = array.array("i", [-1]) * numSegments
+
+    # Build up maximal chains of line segments that separate the same
+    # pair of time zones.  (I'd have called them
+    # sequences, but then I'd have to distinguish "seg" and "seq".)
+    # Chain i runs from point chainBounds[2 * i] to chainBounds[2 * i + 1].
+    chainBounds = array.array("i")
+    dataIO = open(dataFilename, "wb")
+    # The points are collected here and written DATA_BLOCK at a time.
+    dataBuffer = array.array("d")
+    dataIndex = 0
+    chainReferences = 0
+    if scale is not None:
+        # The number of points is filled in at the end.
+        dataIO.write(DATA_HEADER.pack(DATA_MAGIC, 0, scale))
+        encode = quantized_encoder(scale)
+    def flush():
+        if scale is not None:
+            dataIO.write(encode(dataBuffer))
+        else:
+            if sys.byteorder == "big":
+                dataBuffer.byteswap()
+            dataBuffer.tofile(dataIO)
+        del dataBuffer[:]
+    try:
+        for (tz, polygons) in zonePolygons.items():
+            sys.stderr.write("Writing segments for {0}.\n".format(tz))
+            zoneChains = []
+            for polygon in polygons:
+                coords = polygon["points"].tolist()
+                firstEdge = polygon["firstEdge"]
+                # The chains used by this polygon, as chain ids, or as
+                # ~chain id for the chains it runs in reverse.
+                polygonChains = []
+                currentChainID = None
+                currentChainOpen = False
+                # Start at a break between chains, if there is one, so
+                # that the place where the polygon's points happen to
+                # start doesn't split a chain in two.
+                numEdges = polygon["numEdges"]
+                start = 0
+                for segidx in range(numEdges):
+                    if not edge_in_sequence(firstEdge + segidx):
+                        start = segidx
+                        break
+                for i in range(numEdges):
+                    segidx = (start + i) % numEdges
+                    seg = edgeSegs[firstEdge + segidx] >> 1
+                    if segChain[seg] == -1:
+                        # We're responsible for writing this segment
+                        continueChain = i != 0 and currentChainOpen and \
+                                        edge_in_sequence(firstEdge + segidx)
+                        # Points are written in the order this polygon runs the
+                        # segment.
+                        pt = 2 * segidx
+                        if continueChain:
+                            chainBounds[2 * currentChainID + 1] += 1
+                            dataIndex = dataIndex + 1
+                            assert dataIndex == chainBounds[2 * currentChainID + 1]
+                            dataBuffer.extend(coords[pt + 2:pt + 4])
+                        else:
+                            currentChainID = len(chainBounds) // 2
+                            chainBounds.extend((dataIndex, dataIndex + 2))
+                            dataIndex = dataIndex + 2
+                            dataBuffer.extend(coords[pt:pt + 4])
+                            currentChainOpen = True
+                            polygonChains.append(currentChainID)
+                        if len(dataBuffer) >= DATA_BLOCK:
+                            flush()
+                        segChain[seg] = currentChainID
                     else:
-                        [p0, p1] = [ seg.a, seg.b ]
-                    dataIO.write(struct.pack("<4d", p0.lon, p0.lat, p1.lon, p1.lat))
-                    currentChainData = [startIndex, endIndex]
-                    chains.append(currentChainData)
-                    polygonChains.append(currentChainData)
-                segdata.chain = currentChainID
+                        if currentChainID != segChain[seg]:
+                            currentChainID = segChain[seg]
+                            polygonChains.append(~currentChainID)
+                            currentChainOpen = False
+                chainReferences += len(polygonChains)
+                # Write the higher index first to indicate that a chain
+                # is read in reverse.
+                zoneChains.append([chainBounds[2 * chain:2 * chain + 2].tolist()
+                                   if chain >= 0 else
+                                   chainBounds[2 * ~chain:2 * ~chain + 2].tolist()[::-1]
+                                   for chain in polygonChains])
+            yield (tz, zoneChains)
+        flush()
+        if scale is not None:
+            dataIO.seek(0)
+            dataIO.write(DATA_HEADER.pack(DATA_MAGIC, dataIndex, scale))
+        if counts is not None:
+            counts["chains"] = len(chainBounds) // 2
+            counts["chainReferences"] = chainReferences
+            counts["dataPoints"] = dataIndex
+    finally:
+        dataIO.close()
+
+def polygon_bbox(coords):
+    """Returns [west, south, east, north] for a flat list of coordinates.
+    If an edge of the polygon crosses the date line (spans more than 180
+    degrees of longitude, as in tzmap.js), the box is the smallest one
+    around all the edges, and west may be greater than east."""
+    lons = coords[0::2]
+    lats = coords[1::2]
+    edges = list(zip(lons, lons[1:]))
+    if not any(abs(b - a) > 180 for (a, b) in edges):
+        return [min(lons), min(lats), max(lons), max(lats)]
+    edgeBboxes = []
+    for (a, b) in edges:
+        if abs(b - a) > 180:
+            edgeBboxes.append([max(a, b), 0, min(a, b), 0])
+        else:
+            edgeBboxes.append([min(a, b), 0, max(a, b), 0])
+    (west, south, east, north) = union_bbox(edgeBboxes)
+    return [west, min(lats), east, max(lats)]
+
+def normalize_lon(lon):
+    if lon > 180:
+        return lon - 360
+    return lon
+
+def union_bbox(bboxes):
+    """Returns the smallest [west, south, east, north] (which may cross
+    the date line) that contains all of the given ones."""
+    # Turn each box's longitudes into an arc [start, end] with start in
+    # [-180, 180] and end >= start, and merge the overlapping arcs.
+    arcs = sorted([west, east if east >= west else east + 360]
+                  for (west, south, east, north) in bboxes)
+    merged = []
+    for arc in arcs:
+        if merged and arc[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], arc[1])
+        else:
+            merged.append(arc)
+    while len(merged) > 1 and merged[0][0] + 360 <= merged[-1][1]:
+        merged[-1][1] = max(merged[-1][1], merged.pop(0)[1] + 360)
+    south = min(bbox[1] for bbox in bboxes)
+    north = max(bbox[3] for bbox in bboxes)
+    if merged[-1][1] - merged[0][0] >= 360 and len(merged) == 1:
+        return [-180.0, south, 180.0, north]
+    # The box is the complement of the largest gap between the arcs.
+    gap = merged[0][0] + 360 - merged[-1][1]
+    (west, east) = (merged[0][0], merged[-1][1])
+    for i in range(len(merged) - 1):
+        if merged[i + 1][0] - merged[i][1] > gap:
+            gap = merged[i + 1][0] - merged[i][1]
+            (west, east) = (merged[i + 1][0], merged[i][1] + 360)
+    return [west, south, normalize_lon(east), north]
+
+def zone_bboxes(polygons):
+    """Returns the "bboxes" entry of world-map.json for a zone: the
+    bounding box of the whole zone and of each of its polygons."""
+    polygonBboxes = [polygon_bbox(polygon["points"].tolist())
+                     for polygon in polygons]
+    return { "zone": union_bbox(polygonBboxes), "polygons": polygonBboxes }
+
+def write_json(zoneEntries, jsonFilename, phases=None):
+    """Writes world-map.json to jsonFilename, given, for each zone in
+    any order, (tz, a dict from each top-level key of the file to the
+    zone's value under that key).  Each zone's values are spooled to a
+    temporary file as they arrive, and then copied out in sorted order,
+    giving the same output as json.dump(..., sort_keys=True) on the
+    whole thing, without keeping it all in memory.  The time taken by
+    each of those steps is added to phases, if given (see timed): the
+    first, which consumes zoneEntries, as "chains", and the second as
+    "json"."""
+    if phases is None:
+        phases = []
+    spoolIO = tempfile.TemporaryFile()
+    try:
+        # For each top-level key, a list of (tz, offset, length).
+        fragments = {}
+        with timed(phases, "chains"):
+            for (tz, entries) in zoneEntries:
+                for key in entries:
+                    fragment = (json.dumps(tz) + ": " +
+                                json.dumps(entries[key], sort_keys=True)).encode("ascii")
+                    fragments.setdefault(key, []).append((tz, spoolIO.tell(), len(fragment)))
+                    spoolIO.write(fragment)
+        with timed(phases, "json"):
+            jsonIO = open(jsonFilename, "wb")
+            jsonIO.write(b"{")
+            for (k, key) in enumerate(sorted(fragments)):
+                if k != 0:
+                    jsonIO.write(b", ")
+                jsonIO.write((json.dumps(key) + ": {").encode("ascii"))
+                for (i, (tz, offset, length)) in enumerate(sorted(fragments[key])):
+                    if i != 0:
+                        jsonIO.write(b", ")
+                    spoolIO.seek(offset)
+                    jsonIO.write(spoolIO.read(length))
+                jsonIO.write(b"}")
+            jsonIO.write(b"}")
+            jsonIO.close()
+    finally:
+        spoolIO.close()
+
+def simplify_chain(lons, lats, tolerance):
+    """Returns the indices of the points of a chain kept by
+    Douglas-Peucker simplification to within tolerance degrees.  The
+    first and last points are always kept, so that chains still meet
+    where they did, and a chain that is a closed ring (including one
+    around a pole) is split at the point farthest from its start so
+    that it stays a ring."""
+    last = len(lons) - 1
+    # A ring ends where it starts, but its ends may be written 360
+    # degrees apart (at -180 and 180), and once unwrapped below, a ring
+    # around a pole ends 360 degrees from where it starts.
+    ring = last >= 3 and lats[0] == lats[last] and \
+           (lons[last] - lons[0]) % 360 == 0
+    # Measure across the date line as if it weren't there.
+    lons = list(lons)
+    for i in range(1, last + 1):
+        while lons[i] - lons[i - 1] > 180:
+            lons[i] -= 360
+        while lons[i] - lons[i - 1] < -180:
+            lons[i] += 360
+    keep = set([0, last])
+    if ring:
+        far = max(range(1, last),
+                  key=lambda i: (lons[i] - lons[0]) ** 2 + (lats[i] - lats[0]) ** 2)
+        keep.add(far)
+        stack = [(0, far), (far, last)]
+    else:
+        stack = [(0, last)]
+    while stack:
+        (first, end) = stack.pop()
+        if end - first < 2:
+            continue
+        (x0, y0) = (lons[first], lats[first])
+        (dx, dy) = (lons[end] - x0, lats[end] - y0)
+        length = math.hypot(dx, dy)
+        worst = -1
+        # An edge spanning 180 degrees of longitude or more would be
+        # taken to cross the date line the other way, so split it at
+        # its farthest point whatever the tolerance.
+        worstDistance = tolerance if abs(dx) < 180 else -1
+        for i in range(first + 1, end):
+            if length == 0:
+                distance = math.hypot(lons[i] - x0, lats[i] - y0)
             else:
-                if currentChainID != segdata.chain:
-                    currentChainID = segdata.chain
-                    # Write the higher index first to indicate that this
-                    # chain is read in reverse.
-                    [endIndex, startIndex] = chains[currentChainID]
-                    polygonChains.append([startIndex, endIndex])
-                    currentChainData = None
-dataIO.close()
-dataIO = None
-
-json_data = {
-              "zones": { tz: [polygon["chains"] for polygon in polygons]
-                         for (tz, polygons) in zonePolygons.items() }
-            }
-
-jsonIO = open(jsonFilename, "w")
-json.dump(json_data, jsonIO, sort_keys=True)
-jsonIO.close()
-jsonIO = None
+                distance = abs(dx * (lats[i] - y0) - dy * (lons[i] - x0)) / length
+            if distance > worstDistance:
+                worst = i
+                worstDistance = distance
+        if worst != -1:
+            keep.add(worst)
+            stack.append((first, worst))
+            stack.append((worst, end))
+    return sorted(keep)
+
+def lod_filename(filename, tolerance):
+    """Returns the name of the level-of-detail version of filename, which
+    has the same name in a lod-TOLERANCE directory next to it (e.g.,
+    output/lod-0.01/world-map.data for output/world-map.data at a
+    tolerance of 0.01), creating that directory if needed."""
+    (directory, name) = os.path.split(filename)
+    lodDir = os.path.join(directory, "lod-{0:g}".format(tolerance))
+    if not os.path.isdir(lodDir):
+        os.makedirs(lodDir)
+    return os.path.join(lodDir, name)
+
+def write_lods(jsonFilename, dataFilename, tolerances, scale=None):
+    """Writes a simplified copy of world-map.json and world-map.data for
+    each tolerance (in degrees), named by lod_filename.  Each chain is
+    simplified once and written in the same order as in the original,
+    and the zones refer to the same chains in the same way, so each
+    level of detail is a complete world map in the same format (which
+    tzmap.js's loadData can load from its directory), and neighboring
+    zones still share their simplified borders exactly.
+    The data is quantized to scale if given."""
+    jsonIO = open(jsonFilename)
+    world = json.load(jsonIO)
+    jsonIO.close()
+    points = read_points(dataFilename)
+
+    # The chains, as [start, end) in the original data, in data order.
+    chains = sorted(set(tuple(sorted(chain))
+                        for polygons in world["zones"].values()
+                        for polygon in polygons
+                        for chain in polygon))
+    for tolerance in tolerances:
+        sys.stderr.write("Simplifying chains to {0:g} degrees.\n".format(tolerance))
+        lodPoints = array.array("d")
+        lodBounds = {}
+        for (start, end) in chains:
+            lons = points[2 * start:2 * end:2]
+            lats = points[2 * start + 1:2 * end:2]
+            lodStart = len(lodPoints) // 2
+            for i in simplify_chain(lons, lats, tolerance):
+                lodPoints.extend((lons[i], lats[i]))
+            lodBounds[(start, end)] = [lodStart, len(lodPoints) // 2]
+        lodZones = {}
+        for (tz, polygons) in world["zones"].items():
+            lodZones[tz] = [[lodBounds[(chain[0], chain[1])]
+                             if chain[0] < chain[1] else
+                             lodBounds[(chain[1], chain[0])][::-1]
+                             for chain in polygon]
+                            for polygon in polygons]
+        lodIO = open(lod_filename(jsonFilename, tolerance), "w")
+        json.dump({ "bboxes": world["bboxes"], "zones": lodZones }, lodIO,
+                  sort_keys=True)
+        lodIO.close()
+        write_points(lod_filename(dataFilename, tolerance), lodPoints, scale)
+
+def write_index(jsonFilename, indexFilename):
+    """Writes world-map.index to indexFilename, from the world-map.json
+    in jsonFilename."""
+    jsonIO = open(jsonFilename)
+    world = json.load(jsonIO)
+    jsonIO.close()
+    names = sorted(world["zones"])
+    zoneBboxes = array.array("d")
+    polygonBboxes = array.array("d")
+    zonePolygons = array.array("I", [0])
+    polygonChains = array.array("I", [0])
+    chains = array.array("i")
+    for tz in names:
+        zoneBboxes.extend(world["bboxes"][tz]["zone"])
+        for bbox in world["bboxes"][tz]["polygons"]:
+            polygonBboxes.extend(bbox)
+        for polygon in world["zones"][tz]:
+            for chain in polygon:
+                chains.extend(chain)
+            polygonChains.append(len(chains) // 2)
+        zonePolygons.append(len(polygonChains) - 1)
+    nameBytes = "\n".join(names).encode("utf-8")
+
+    indexIO = open(indexFilename, "wb")
+    try:
+        indexIO.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                        len(names), len(polygonChains) - 1,
+                                        len(chains) // 2, len(nameBytes)))
+        for a in (zoneBboxes, polygonBboxes, zonePolygons, polygonChains,
+                  chains):
+            if sys.byteorder == "big":
+                a.byteswap()
+            a.tofile(indexIO)
+        indexIO.write(nameBytes)
+    finally:
+        indexIO.close()
+
+def build_grid(zonePolygons, cellSize):
+    """Returns the grid index (world-map-grid.json): the world divided
+    into cells of cellSize degrees, numbered by row from the south and
+    then by column from the west.  Each cell is the index in "zones" of
+    the zone that contains all of it, null if no zone has any of it, or
+    a list of the zones that might contain a given point in it (the ones
+    whose boundaries cross it, and any that contain its center), each of
+    which needs an exact test."""
+    names = sorted(zonePolygons)
+    columns = int(math.ceil(360.0 / cellSize))
+    rows = int(math.ceil(180.0 / cellSize))
+    def column_at(lon):
+        return max(0, min(columns - 1, int((lon + 180) // cellSize)))
+    def row_at(lat):
+        return max(0, min(rows - 1, int((lat + 90) // cellSize)))
+    def centers_in(origin, lo, hi, count):
+        """Returns the range of the cells whose center is in [lo, hi)."""
+        first = int(math.ceil((lo - origin) / cellSize - 0.5))
+        stop = int(math.ceil((hi - origin) / cellSize - 0.5))
+        return range(max(first, 0), min(stop, count))
+
+    # For each cell, the zones whose boundaries cross it.
+    boundary = {}
+    # For each column, (polygon serial number, zone, latitude) for each
+    # place where an edge crosses the line through the column's center.
+    crossings = [[] for column in range(columns)]
+    serial = 0
+    for (z, tz) in enumerate(names):
+        for polygon in zonePolygons[tz]:
+            coords = polygon["points"].tolist()
+            for i in range(0, len(coords) - 2, 2):
+                (lon0, lat0, lon1, lat1) = coords[i:i + 4]
+                crossesDateLine = abs(lon1 - lon0) > 180
+                if crossesDateLine:
+                    lonRanges = [(-180, min(lon0, lon1)), (max(lon0, lon1), 180)]
+                else:
+                    lonRanges = [(min(lon0, lon1), max(lon0, lon1))]
+                for (west, east) in lonRanges:
+                    for row in range(row_at(min(lat0, lat1)),
+                                     row_at(max(lat0, lat1)) + 1):
+                        for column in range(column_at(west), column_at(east) + 1):
+                            boundary.setdefault(row * columns + column, set()).add(z)
+
+                # Count crossings the way tzmap.js does: an edge covers
+                # the longitudes from its west end up to but not
+                # including its east end, and an edge that crosses the
+                # date line is measured in [0, 360).
+                if lon0 == lon1:
+                    continue
+                if crossesDateLine:
+                    lon0 = (lon0 + 360) % 360
+                    lon1 = (lon1 + 360) % 360
+                if lon1 < lon0:
+                    (lon0, lat0, lon1, lat1) = (lon1, lat1, lon0, lat0)
+                columnRanges = [centers_in(-180, lon0, lon1, columns)]
+                if crossesDateLine:
+                    columnRanges.append(centers_in(-180, lon0 - 360, lon1 - 360,
+                                                   columns))
+                for columnRange in columnRanges:
+                    for column in columnRange:
+                        lon = -180 + (column + 0.5) * cellSize
+                        if lon < lon0:
+                            lon += 360
+                        lat = lat0 + (lat1 - lat0) * ((lon - lon0) / (lon1 - lon0))
+                        crossings[column].append((serial, z, lat))
+            serial += 1
+
+    # For each cell, the zones that contain its center: a point is in a
+    # polygon if an odd number of its edges cross the line north of it.
+    inside = {}
+    for column in range(columns):
+        crossings[column].sort()
+        start = 0
+        while start < len(crossings[column]):
+            (serial, z) = crossings[column][start][0:2]
+            stop = start
+            while stop < len(crossings[column]) and \
+                  crossings[column][stop][0] == serial:
+                stop += 1
+            lats = [-float("inf")] + \
+                   [crossing[2] for crossing in crossings[column][start:stop]] + \
+                   [float("inf")]
+            count = stop - start
+            for i in range(1, len(lats)):
+                if (count - (i - 1)) % 2 == 1:
+                    for row in centers_in(-90, lats[i - 1], lats[i], rows):
+                        inside.setdefault(row * columns + column, set()).add(z)
+            start = stop
+        crossings[column] = None
+
+    cells = []
+    for cell in range(rows * columns):
+        zones = inside.get(cell, set())
+        if cell in boundary:
+            cells.append(sorted(boundary[cell] | zones))
+        elif len(zones) == 1:
+            cells.append(min(zones))
+        elif zones:
+            cells.append(sorted(zones))
+        else:
+            cells.append(None)
+    return { "cellSize": cellSize, "columns": columns, "rows": rows,
+             "west": -180, "south": -90, "zones": names, "cells": cells }
+
+def main():
+    op = OptionParser()
+    op.add_option("--shapefile", dest="shapefile", default=SHAPEFILE_ZIP,
+                  help="the time zone shapefile to read: a zip file, or "
+                       "the .shp file or base name of an unpacked one "
+                       "(default ../tzmap/tz_world_mp.zip)")
+    op.add_option("--member", dest="member", default=SHAPEFILE_MEMBER,
+                  help="the base name of the shapefile within the "
+                       "--shapefile zip (default " + SHAPEFILE_MEMBER + ")")
+    op.add_option("--topology", dest="topology", type="choice",
+                  choices=["dict", "sort"], default="dict",
+                  help="how to find the segments shared between polygons: "
+                       "\"dict\" (one edge at a time, the default) or "
+                       "\"sort\" (all edges at once, requires NumPy)")
+    op.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                  help="number of processes used to read the shapefile "
+                       "and to build the dict topology (default 1)")
+    op.add_option("--split-overlaps", dest="splitOverlaps",
+                  action="store_true", default=False,
+                  help="split edges at the points of other polygons that "
+                       "lie on them, so that borders where one polygon's "
+                       "segment is part of another's are shared")
+    op.add_option("--overlap-tolerance", dest="overlapTolerance",
+                  type="float", default=1e-9,
+                  help="how far (in degrees) a point may be from an edge "
+                       "and still be considered on it by --split-overlaps "
+                       "(default 1e-9)")
+    op.add_option("--cache-dir", dest="cacheDir", default=None,
+                  help="directory in which to keep each zone's segments "
+                       "between runs of the dict topology, so that only "
+                       "zones that changed are recomputed")
+    op.add_option("--index", dest="indexFilename", default=None,
+                  help="also write the zones' chains as a binary index "
+                       "(world-map.index) to this file, and for each --lod")
+    op.add_option("--quantize", dest="quantize", type="float", default=None,
+                  metavar="SCALE",
+                  help="write world-map.data compactly, with the "
+                       "coordinates rounded to multiples of SCALE degrees "
+                       "(e.g., 1e-6) and stored as varint differences "
+                       "from the previous point")
+    op.add_option("--lod", dest="lodTolerances", type="float",
+                  action="append", default=[], metavar="TOLERANCE",
+                  help="also write a copy of both outputs (and of the "
+                       "--index) with each chain simplified to within "
+                       "TOLERANCE degrees, under the same names in a "
+                       "lod-TOLERANCE directory next to them, e.g., "
+                       "output/lod-0.01/ for --lod 0.01 (may be given more "
+                       "than once); each shared border is simplified once, "
+                       "so neighboring zones still meet exactly, but "
+                       "borders are simplified independently, so a "
+                       "simplified border may cross another")
+    op.add_option("--metrics", dest="metricsFilename", default=None,
+                  help="write a JSON report of the time taken by each "
+                       "phase, the numbers of points, segments and chains, "
+                       "and the peak memory use to this file")
+    op.add_option("--grid", dest="gridFilename", default=None,
+                  help="also write a grid index from cells to candidate "
+                       "zones (world-map-grid.json) to this file")
+    op.add_option("--grid-size", dest="gridSize", type="float", default=1.0,
+                  help="size in degrees of the cells of the --grid index "
+                       "(default 1)")
+    (options, args) = op.parse_args()
+
+    if len(args) != 2:
+        op.error("expected two arguments but got {0}".format(len(args)))
+    if options.topology == "sort" and numpy is None:
+        op.error("--topology=sort requires NumPy")
+    if options.jobs < 1:
+        op.error("--jobs must be at least 1")
+    if options.cacheDir is not None and options.topology != "dict":
+        op.error("--cache-dir only works with --topology=dict")
+    if not 0 < options.gridSize <= 180:
+        op.error("--grid-size must be more than 0 and at most 180")
+    if options.quantize is not None and not options.quantize > 0:
+        op.error("--quantize must be more than 0")
+    if any(tolerance <= 0 for tolerance in options.lodTolerances):
+        op.error("--lod tolerances must be more than 0")
+    jsonFilename = args[0]
+    dataFilename = args[1]
+
+    # For --metrics.
+    phases = []
+    counts = {}
+
+    with timed(phases, "read"):
+        zonePolygons = read_zones(options.jobs, options.shapefile,
+                                  options.member)
+    if options.splitOverlaps:
+        sys.stderr.write("Splitting overlapping edges.\n")
+        with timed(phases, "split overlaps"):
+            split_overlaps(zonePolygons, options.overlapTolerance)
+    polygons = [polygon for polygons in zonePolygons.values()
+                        for polygon in polygons]
+    sys.stderr.write("Building segments.\n")
+    with timed(phases, "segments"):
+        if options.topology == "sort":
+            topology = sorted_topology(polygons)
+        elif options.cacheDir is not None:
+            (parts, pairs) = cached_zone_topology(zonePolygons,
+                                                  options.cacheDir,
+                                                  options.jobs)
+            topology = dict_topology(polygons, parts=parts, pairs=pairs)
+            parts = pairs = None
+        else:
+            topology = dict_topology(polygons, options.jobs)
+    counts["zones"] = len(zonePolygons)
+    counts["polygons"] = len(polygons)
+    counts["vertices"] = sum(len(polygon["points"]) // 2
+                             for polygon in polygons)
+    counts["edges"] = len(topology[0])
+    # The number of distinct segments in the map, whichever topology
+    # built them.  Merging the topologies of runs of polygons leaves
+    # some segment ids unused, so count the ones that are.
+    segUsed = bytearray(topology[1])
+    for edgeSeg in topology[0]:
+        segUsed[edgeSeg >> 1] = 1
+    counts["distinctSegments"] = len(segUsed) - segUsed.count(b"\0")
+    segUsed = None
+    # Each shared segment is run by two edges, and every other segment
+    # by one.
+    counts["sharedSegments"] = counts["edges"] - counts["distinctSegments"]
+    write_json(((tz, { "zones": chains,
+                       "bboxes": zone_bboxes(zonePolygons[tz]) })
+                for (tz, chains) in write_chains(zonePolygons, topology,
+                                                 dataFilename,
+                                                 options.quantize, counts)),
+               jsonFilename, phases)
+    topology = None
+
+    if options.lodTolerances:
+        with timed(phases, "lod"):
+            write_lods(jsonFilename, dataFilename, options.lodTolerances,
+                       options.quantize)
+
+    if options.indexFilename is not None:
+        with timed(phases, "index"):
+            write_index(jsonFilename, options.indexFilename)
+            for tolerance in options.lodTolerances:
+                write_index(lod_filename(jsonFilename, tolerance),
+                            lod_filename(options.indexFilename, tolerance))
+
+    if options.gridFilename is not None:
+        sys.stderr.write("Building grid index.\n")
+        with timed(phases, "grid"):
+            gridIO = open(options.gridFilename, "w")
+            json.dump(build_grid(zonePolygons, options.gridSize), gridIO,
+                      sort_keys=True)
+            gridIO.close()
+
+    if options.metricsFilename is not None:
+        (peakRSS, childrenPeakRSS) = peak_rss()
+        metricsIO = open(options.metricsFilename, "w")
+        json.dump({ "phases": phases,
+                    "counts": counts,
+                    "peakRSS": peakRSS,
+                    "childrenPeakRSS": childrenPeakRSS,
+                    "outputs": dict((filename, os.path.getsize(filename))
+                                    for filename in (jsonFilename,
+                                                     dataFilename)) },
+                  metricsIO, indent=2, sort_keys=True)
+        metricsIO.write("\n")
+        metricsIO.close()
+
+if __name__ == "__main__":
+    main()
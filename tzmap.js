@@ -17,13 +17,19 @@
 
     var gXHR = null;
     var gDataXHR = null;
+    var gGridXHR = null;
     var gLoadSuccessCallbacks = [];
     var gLoadErrorCallbacks = [];
-    var gJSON = null;
+    var gIndex = null;
     var gData = null;
+    var gGrid = null;
+    var gGridDone = false;
 
-    var public_loadData = function(path, success_callback, error_callback) {
-        if (gJSON && jData) {
+    var gLittleEndian = new Uint8Array(new Uint16Array([1]).buffer)[0] == 1;
+
+    var public_loadData = function(path, success_callback, error_callback,
+                                   options) {
+        if (gIndex && gData) {
             if (success_callback) {
                 setTimeout(success_callback, 0);
             }
@@ -48,11 +54,16 @@
             isHTTP = window.location.protocol == "http:" ||
                      window.location.protocol == "https:";
         }
-        var json_path = path + "world-map.json";
+        var useBinaryIndex = !!(options && options.index);
+        var useGrid = !!(options && options.grid);
+        var json_path = path + (useBinaryIndex ? "world-map.index"
+                                               : "world-map.json");
         var data_path = path + "world-map.data";
+        var grid_path = path + "world-map-grid.json";
         if (isHTTP) {
             json_path += ".gz";
             data_path += ".gz";
+            grid_path += ".gz";
         }
 
         function do_notify(success) {
@@ -75,22 +86,27 @@
 
             var success = false;
             if (!isHTTP || (200 <= gXHR.status && gXHR.status < 300)) {
-                var json = null;
                 try {
-                    if ("responseType" in gXHR && gXHR.responseType == "json") {
-                        json = gXHR.response;
+                    if (useBinaryIndex) {
+                        gIndex = parse_index(gXHR.response);
                     } else {
-                        json = JSON.parse(gXHR.responseText);
+                        var json;
+                        if ("responseType" in gXHR &&
+                            gXHR.responseType == "json") {
+                            json = gXHR.response;
+                        } else {
+                            json = JSON.parse(gXHR.responseText);
+                        }
+                        if (json && json.zones) {
+                            gIndex = index_from_json(json);
+                        }
                     }
                 } catch (ex) {
                 }
-                if (json && json.zones) {
-                    success = true;
-                    gJSON = json;
-                }
+                success = !!gIndex;
             }
 
-            if (!success || gData) {
+            if (!success || (gData && gGridDone)) {
                 do_notify(success);
             }
         }
@@ -103,22 +119,54 @@
             var success = false;
             if (!isHTTP || (200 <= gDataXHR.status && gDataXHR.status < 300)) {
                 if (gDataXHR.responseType == "arraybuffer") {
-                    var arraybuffer = gDataXHR.response;
-                    gData = new DataView(arraybuffer);
-                    success = true;
+                    gData = decode_data(gDataXHR.response);
+                    success = !!gData;
                 }
             }
 
-            if (!success || gJSON) {
+            if (!success || (gIndex && gGridDone)) {
                 do_notify(success);
             }
         }
 
+        // The grid index is optional; without it (or if it fails to
+        // load), zoneAt just tests every zone.
+        function grid_rsc() {
+            if (gGridXHR.readyState != 4) {
+                return;
+            }
+
+            if (!isHTTP || (200 <= gGridXHR.status && gGridXHR.status < 300)) {
+                try {
+                    var grid;
+                    if ("responseType" in gGridXHR &&
+                        gGridXHR.responseType == "json") {
+                        grid = gGridXHR.response;
+                    } else {
+                        grid = JSON.parse(gGridXHR.responseText);
+                    }
+                    if (grid && grid.cells) {
+                        gGrid = grid;
+                    }
+                } catch (ex) {
+                }
+            }
+            gGridXHR = null;
+            gGridDone = true;
+
+            if (gIndex && gData) {
+                do_notify(true);
+            }
+        }
+
+        gGridDone = !useGrid;
         try {
             gXHR = new XMLHttpRequest();
             gXHR.onreadystatechange = json_rsc;
             gXHR.open("GET", json_path);
-            if ("responseType" in gXHR) {
+            if (useBinaryIndex) {
+                gXHR.responseType = "arraybuffer";
+            } else if ("responseType" in gXHR) {
                 try {
                     gXHR.responseType = "json";
                 } catch(ex) {
@@ -135,6 +183,27 @@
             gDataXHR.send();
         } catch(ex) {
             do_notify(false);
+            return;
+        }
+
+        if (!useGrid) {
+            return;
+        }
+        try {
+            gGridXHR = new XMLHttpRequest();
+            gGridXHR.onreadystatechange = grid_rsc;
+            gGridXHR.open("GET", grid_path);
+            if ("responseType" in gGridXHR) {
+                try {
+                    gGridXHR.responseType = "json";
+                } catch(ex) {
+                    gGridXHR.responseType = "text";
+                }
+            }
+            gGridXHR.send();
+        } catch(ex) {
+            gGridXHR = null;
+            gGridDone = true;
         }
     }
 
@@ -149,12 +218,192 @@
         }
     }
 
-    function zoneContains(tzid, lat, lon) {
-        var zones = gJSON.zones;
+    /**
+     * The zone index, whether it came from world-map.json or
+     * world-map.index, is an object with:
+     *   names: the zone names, sorted
+     *   zoneIds: a map from each name to its index in names
+     *   zonePolygons: the index of each zone's first polygon, plus the
+     *     number of polygons at the end
+     *   polygonChains: the index of each polygon's first chain, plus
+     *     the number of chains at the end
+     *   chains: the start and end of each chain, in pairs, where the
+     *     end is one past the last point, and a chain used in reverse
+     *     has its start and end swapped
+     *   zoneBboxes, polygonBboxes: the bounding box of each zone and
+     *     polygon as [west, south, east, north] in a flat array, or
+     *     null for older data files that don't have them
+     */
+    function index_from_json(json) {
+        var names = [];
+        for (var tzid in json.zones) {
+            names.push(tzid);
+        }
+        names.sort();
+
+        var polygonCount = 0, chainCount = 0;
+        for (var z = 0; z < names.length; ++z) {
+            var zone = json.zones[names[z]];
+            polygonCount += zone.length;
+            for (var polygonIdx = 0; polygonIdx < zone.length; ++polygonIdx) {
+                chainCount += zone[polygonIdx].length;
+            }
+        }
+
+        var index = {
+            names: names,
+            zonePolygons: new Uint32Array(names.length + 1),
+            polygonChains: new Uint32Array(polygonCount + 1),
+            chains: new Int32Array(chainCount * 2),
+            zoneBboxes: null,
+            polygonBboxes: null
+        };
+        if (json.bboxes) {
+            index.zoneBboxes = new Float64Array(names.length * 4);
+            index.polygonBboxes = new Float64Array(polygonCount * 4);
+        }
+        var p = 0, c = 0;
+        for (var z = 0; z < names.length; ++z) {
+            var zone = json.zones[names[z]];
+            var bboxes = json.bboxes ? json.bboxes[names[z]] : null;
+            if (bboxes) {
+                index.zoneBboxes.set(bboxes.zone, z * 4);
+            }
+            index.zonePolygons[z] = p;
+            for (var polygonIdx = 0; polygonIdx < zone.length; ++polygonIdx) {
+                var polygon = zone[polygonIdx];
+                if (bboxes) {
+                    index.polygonBboxes.set(bboxes.polygons[polygonIdx], p * 4);
+                }
+                index.polygonChains[p++] = c;
+                for (var chainIdx = 0; chainIdx < polygon.length; ++chainIdx) {
+                    index.chains[c * 2] = polygon[chainIdx][0];
+                    index.chains[c * 2 + 1] = polygon[chainIdx][1];
+                    ++c;
+                }
+            }
+        }
+        index.zonePolygons[names.length] = p;
+        index.polygonChains[polygonCount] = c;
+        return add_zone_ids(index);
+    }
+
+    /**
+     * Build the zone index from world-map.index (written by
+     * shapefile-to-json.py --index), using its arrays in place where
+     * possible.  Returns null if the data are malformed.
+     */
+    function parse_index(arraybuffer) {
+        var view = new DataView(arraybuffer);
+        var length = arraybuffer.byteLength;
+        if (length < 24 ||
+            view.getUint32(0, false) != 0x545a4d49 /* "TZMI" */ ||
+            view.getUint32(4, true) != 1) {
+            return null;
+        }
+        var zoneCount = view.getUint32(8, true);
+        var polygonCount = view.getUint32(12, true);
+        var chainCount = view.getUint32(16, true);
+        var namesLength = view.getUint32(20, true);
+        var offset = 24;
+        if (length != offset + (zoneCount + polygonCount) * 32 +
+                      (zoneCount + polygonCount + 2) * 4 +
+                      chainCount * 8 + namesLength) {
+            return null;
+        }
+
+        function take(Type, getter, count) {
+            var result;
+            if (gLittleEndian) {
+                result = new Type(arraybuffer, offset, count);
+            } else {
+                result = new Type(count);
+                for (var i = 0; i < count; ++i) {
+                    result[i] = view[getter](offset + i * Type.BYTES_PER_ELEMENT, true);
+                }
+            }
+            offset += count * Type.BYTES_PER_ELEMENT;
+            return result;
+        }
+        var index = {
+            zoneBboxes: take(Float64Array, "getFloat64", zoneCount * 4),
+            polygonBboxes: take(Float64Array, "getFloat64", polygonCount * 4),
+            zonePolygons: take(Uint32Array, "getUint32", zoneCount + 1),
+            polygonChains: take(Uint32Array, "getUint32", polygonCount + 1),
+            chains: take(Int32Array, "getInt32", chainCount * 2)
+        };
+
+        var bytes = new Uint8Array(arraybuffer, offset, namesLength);
+        var names;
+        if (typeof(TextDecoder) != "undefined") {
+            names = new TextDecoder("utf-8").decode(bytes);
+        } else {
+            names = "";
+            for (var i = 0; i < bytes.length; ++i) {
+                names += String.fromCharCode(bytes[i]);
+            }
+            names = decodeURIComponent(escape(names));
+        }
+        index.names = zoneCount ? names.split("\n") : [];
+        if (index.names.length != zoneCount) {
+            return null;
+        }
+        return add_zone_ids(index);
+    }
+
+    function add_zone_ids(index) {
+        index.zoneIds = {};
+        for (var z = 0; z < index.names.length; ++z) {
+            index.zoneIds[index.names[z]] = z;
+        }
+        return index;
+    }
+
+    /**
+     * Return the index of the zone with the given name, or -1 if there
+     * is none.
+     */
+    function zone_id(tzid) {
+        if (!Object.prototype.hasOwnProperty.call(gIndex.zoneIds, tzid)) {
+            return -1;
+        }
+        return gIndex.zoneIds[tzid];
+    }
+
+    /**
+     * Check if the point is in the idx'th bounding box of bboxes, a
+     * flat array of [west, south, east, north].  If west > east, the
+     * box crosses the date line.
+     */
+    function bbox_contains(bboxes, idx, lat, lon) {
+        var west = bboxes[idx * 4], south = bboxes[idx * 4 + 1];
+        var east = bboxes[idx * 4 + 2], north = bboxes[idx * 4 + 3];
+        if (lat < south || lat > north) {
+            return false;
+        }
+        if (west <= east) {
+            return west <= lon && lon <= east;
+        }
+        return west <= lon || lon <= east;
+    }
+
+    function zoneContains(z, lat, lon) {
+        var index = gIndex;
+
+        // The bounding boxes let us skip most zones (and most polygons
+        // of the rest) without looking at their points.  Older data
+        // files don't have them.
+        if (index.zoneBboxes && !bbox_contains(index.zoneBboxes, z, lat, lon)) {
+            return false;
+        }
 
-        var zone = zones[tzid];
-        for (var polygonIdx in zone) {
-            var polygon = zone[polygonIdx];
+        for (var polygonIdx = index.zonePolygons[z],
+                 polygonEnd = index.zonePolygons[z + 1];
+             polygonIdx < polygonEnd; ++polygonIdx) {
+            if (index.polygonBboxes &&
+                !bbox_contains(index.polygonBboxes, polygonIdx, lat, lon)) {
+                continue;
+            }
 
             // Since we don't need to worry about zones containing the
             // north pole (FIXME: really?), we can just count the number
@@ -164,10 +413,11 @@
             // need to worry about whether they're great circle lines or
             // lines on an easier projection.
             var intersects = 0;
-            for (var chainIdx in polygon) {
-                var chainobj = polygon[chainIdx];
-                var start = chainobj[0];
-                var end = chainobj[1];
+            for (var chainIdx = index.polygonChains[polygonIdx],
+                     chainEnd = index.polygonChains[polygonIdx + 1];
+                 chainIdx < chainEnd; ++chainIdx) {
+                var start = index.chains[chainIdx * 2];
+                var end = index.chains[chainIdx * 2 + 1];
                 var increment;
                 if (end > start) {
                     --end;
@@ -192,20 +442,27 @@
                             var alon, ptalon, prevalon;
                             if (Math.abs(ptlon - prevlon) > 180) {
                                 // this segment crosses the date line,
-                                // so use adjusted numbers instead
-                                alon = (lon + 180) % 360;
-                                ptalon = (ptlon + 180) % 360;
-                                prevalon = (prevlon + 180) % 360;
+                                // so use adjusted numbers (in [0, 360),
+                                // where the date line is at 180)
+                                // instead
+                                alon = (lon + 360) % 360;
+                                ptalon = (ptlon + 360) % 360;
+                                prevalon = (prevlon + 360) % 360;
                             } else {
                                 alon = lon;
                                 ptalon = ptlon;
                                 prevalon = prevlon;
                             }
 
+                            // Put the west end first, keeping each
+                            // latitude with its longitude.
+                            var ptalat = ptlat, prevalat = prevlat;
                             if (ptalon < prevalon) {
                                 var tmp = ptalon;
                                 ptalon = prevalon;
                                 prevalon = tmp;
+                                ptalat = prevlat;
+                                prevalat = ptlat;
                             }
 
                             // Check the endpoint at the west end but
@@ -217,7 +474,7 @@
                             // from the boundary.  FIXME: But it's not
                             // quite right for the on-the-line check.
                             if (prevalon <= alon && alon < ptalon) {
-                                var xlat = prevlat + (ptlat - prevlat) * ((alon - prevalon) / (ptalon - prevalon));
+                                var xlat = prevalat + (ptalat - prevalat) * ((alon - prevalon) / (ptalon - prevalon));
                                 if (xlat == lat)
                                     // on the line
                                     return true;
@@ -238,31 +495,143 @@
         return false;
     }
 
+    /**
+     * Return lon in [-180, 180), unchanged if it already is.
+     */
+    function normalize_lon(lon) {
+        lon = lon % 360;
+        if (lon < -180) {
+            lon += 360;
+        } else if (lon >= 180) {
+            lon -= 360;
+        }
+        return lon;
+    }
+
     var public_zoneContains = function(zone, lat, lon) {
         if (lat >= 90 || lat <= -90)
             return null;
-        lon = ((lon % 360) + 180) % 360 - 180;
+        lon = normalize_lon(lon);
 
-        return zoneContains(zone, lat, lon);
+        var z = zone_id(zone);
+        if (z == -1) {
+            return false;
+        }
+        return zoneContains(z, lat, lon);
     }
 
     var public_zoneAt = function(lat, lon) {
         if (lat >= 90 || lat <= -90)
             return null;
-        lon = ((lon % 360) + 180) % 360 - 180;
+        lon = normalize_lon(lon);
 
-        for (var tzid in gJSON.zones) {
-            if (zoneContains(tzid, lat, lon)) {
-                return tzid;
+        var cell = gridCell(lat, lon);
+        if (cell === null) {
+            return null;
+        }
+        if (typeof(cell) == "number") {
+            return gGrid.zones[cell];
+        }
+        if (cell !== undefined) {
+            // Only the zones listed for the cell can contain the point.
+            for (var idx in cell) {
+                var tzid = gGrid.zones[cell[idx]];
+                var z = zone_id(tzid);
+                if (z != -1 && zoneContains(z, lat, lon)) {
+                    return tzid;
+                }
+            }
+            return null;
+        }
+
+        for (var z = 0; z < gIndex.names.length; ++z) {
+            if (zoneContains(z, lat, lon)) {
+                return gIndex.names[z];
             }
         }
         return null;
     }
 
+    /**
+     * Return the grid index's entry for the cell containing the point:
+     * the index of the zone containing the whole cell, null if no zone
+     * has any of it, or an array of the indices of the zones that
+     * might contain the point.  Returns undefined if there is no grid
+     * index.
+     */
+    function gridCell(lat, lon) {
+        if (!gGrid) {
+            return undefined;
+        }
+        var column = Math.floor((lon - gGrid.west) / gGrid.cellSize);
+        var row = Math.floor((lat - gGrid.south) / gGrid.cellSize);
+        column = Math.max(0, Math.min(gGrid.columns - 1, column));
+        row = Math.max(0, Math.min(gGrid.rows - 1, row));
+        return gGrid.cells[row * gGrid.columns + column];
+    }
+
+    /**
+     * Decode world-map.data into a Float64Array of lon, lat values.
+     * The file is either just those values as little-endian doubles, or
+     * (from shapefile-to-json.py --quantize) a header with the magic
+     * number "TZMQ", the number of points, and the scale, followed by
+     * the changes in longitude and latitude from each point to the
+     * next, in multiples of the scale, as zigzag-encoded varints.
+     * Returns null if the data are malformed.
+     */
+    function decode_data(arraybuffer) {
+        var view = new DataView(arraybuffer);
+        var length = arraybuffer.byteLength;
+        var points;
+        if (length >= 16 &&
+            view.getUint32(0, false) == 0x545a4d51 /* "TZMQ" */) {
+            var count = view.getUint32(4, true);
+            var scale = view.getFloat64(8, true);
+            var bytes = new Uint8Array(arraybuffer, 16);
+            points = new Float64Array(count * 2);
+            var previous = [0, 0];
+            var i = 0;
+            var v = 0, mult = 1;
+            for (var pos = 0; pos < bytes.length; ++pos) {
+                var b = bytes[pos];
+                // Values can be more than 32 bits, so avoid bitwise
+                // operators on them.
+                v += (b & 0x7f) * mult;
+                if (b & 0x80) {
+                    mult *= 128;
+                    continue;
+                }
+                if (i == points.length) {
+                    return null;
+                }
+                previous[i % 2] += (v % 2) ? -(v + 1) / 2 : v / 2;
+                points[i] = previous[i % 2] * scale;
+                ++i;
+                v = 0;
+                mult = 1;
+            }
+            if (i != points.length) {
+                return null;
+            }
+        } else {
+            if (length % 16 != 0) {
+                return null;
+            }
+            if (gLittleEndian) {
+                // Use the doubles in place.
+                points = new Float64Array(arraybuffer);
+            } else {
+                points = new Float64Array(length / 8);
+                for (var idx = 0; idx < points.length; ++idx) {
+                    points[idx] = view.getFloat64(idx * 8, true);
+                }
+            }
+        }
+        return points;
+    }
+
     function pointat(index) {
-        var lon = gData.getFloat64(index * 16, true);
-        var lat = gData.getFloat64(index * 16 + 8, true);
-        return [lon, lat];
+        return [gData[index * 2], gData[index * 2 + 1]];
     }
 
     function pts_equal(a, b) {
@@ -274,15 +643,20 @@
         // than the end, then the points are used in reverse.
         var chains = [];
 
+        var index = gIndex;
         for (var zoneIdx in zone_array) {
-            var tzid = zone_array[zoneIdx];
-            var zone = gJSON.zones[tzid];
-            for (var polygonIdx in zone) {
-                var polygon = zone[polygonIdx];
-                for (var chainIdx in polygon) {
-                    var chainobj = polygon[chainIdx];
-                    var start = chainobj[0];
-                    var end = chainobj[1];
+            var z = zone_id(zone_array[zoneIdx]);
+            if (z == -1) {
+                continue;
+            }
+            for (var polygonIdx = index.zonePolygons[z],
+                     polygonEnd = index.zonePolygons[z + 1];
+                 polygonIdx < polygonEnd; ++polygonIdx) {
+                for (var chainIdx = index.polygonChains[polygonIdx],
+                         chainEnd = index.polygonChains[polygonIdx + 1];
+                     chainIdx < chainEnd; ++chainIdx) {
+                    var start = index.chains[chainIdx * 2];
+                    var end = index.chains[chainIdx * 2 + 1];
                     // Convert one-past-end index to last-item
                     // index given start:end hashing.
                     if (end > start) {
@@ -512,12 +886,7 @@
     var gAllZones = null;
     var public_allZones = function() {
         if (!gAllZones) {
-            var zones = [];
-            for (var zone in gJSON.zones) {
-                zones.push(zone);
-            }
-            zones.sort();
-            gAllZones = zones;
+            gAllZones = gIndex.names.slice();
         }
         return gAllZones;
     }
@@ -525,7 +894,7 @@
     // Exports:
     window.tzmap = {
         /**
-         * loadData(path, success_callback, error_callback)
+         * loadData(path, success_callback, error_callback, options)
          *
          * This library has to load a significant amount of timezone
          * boundary data in order to work.  This function triggers the
@@ -536,6 +905,18 @@
          * successfully, success_callback is called; if it fails,
          * error_callback is called.
          *
+         * options is optional.  If options.index is true, the zones are
+         * loaded from world-map.index (see shapefile-to-json.py
+         * --index), which is used without parsing, instead of
+         * world-map.json.  If options.grid is true, the grid index
+         * world-map-grid.json (see shapefile-to-json.py --grid) is
+         * loaded too, and zoneAt uses it to test only the zones that
+         * might contain each point; if it can't be loaded, zoneAt tests
+         * every zone.
+         *
+         * To use a simplified level of detail (see shapefile-to-json.py
+         * --lod), give its lod-TOLERANCE directory as the path.
+         *
          * Other methods of this library can be used only after
          * success_callback has been called.
          */
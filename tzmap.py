@@ -0,0 +1,297 @@
+# tzmap.js - Library for working with the geography of timezones in JavaScript
+
+# Written in 2011 by L. David Baron <dbaron@dbaron.org>
+
+# To the extent possible under law, the author(s) have dedicated all
+# copyright and related and neighboring rights to this software to the
+# public domain worldwide.  This software is distributed without any
+# warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication
+# along with this software.  If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+# Time zone lookups in Python, over the same files tzmap.js uses (as
+# written by shapefile-to-json.py), with the same results:
+#
+#   import tzmap
+#   world = tzmap.TZMap("output/")
+#   world.zone_at(37.77, -122.42)       # "America/Los_Angeles"
+#   world.zone_contains("America/Los_Angeles", 37.77, -122.42)  # True
+
+import os
+import sys
+import json
+import math
+import array
+import struct
+
+__all__ = ["TZMap"]
+
+# See shapefile-to-json.py for these formats.
+DATA_MAGIC = b"TZMQ"
+DATA_HEADER = struct.Struct("<4sId")
+INDEX_MAGIC = b"TZMI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIIIII")
+
+def _read_array(typecode, data, offset, count):
+    """Returns count little-endian items of the given array typecode from
+    the bytes data, starting at offset."""
+    a = array.array(typecode)
+    chunk = data[offset:offset + count * a.itemsize]
+    if hasattr(a, "frombytes"):
+        a.frombytes(chunk)
+    else:
+        a.fromstring(chunk)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+def _read_points(dataFilename):
+    """Returns the points of world-map.data, in either format, as a flat
+    array('d') of lon, lat values."""
+    dataIO = open(dataFilename, "rb")
+    try:
+        data = dataIO.read()
+    finally:
+        dataIO.close()
+    if data[:len(DATA_MAGIC)] != DATA_MAGIC:
+        return _read_array("d", data, 0, len(data) // 8)
+    (magic, count, scale) = DATA_HEADER.unpack_from(data)
+    points = array.array("d")
+    previous = [0, 0]
+    v = 0
+    shift = 0
+    for b in bytearray(data[DATA_HEADER.size:]):
+        v |= (b & 0x7f) << shift
+        shift += 7
+        if b & 0x80:
+            continue
+        if v & 1:
+            v = -((v + 1) >> 1)
+        else:
+            v >>= 1
+        i = len(points) % 2
+        previous[i] += v
+        points.append(previous[i] * scale)
+        v = 0
+        shift = 0
+    if len(points) != 2 * count:
+        raise ValueError("{0}: expected {1} points, found {2}"
+                         .format(dataFilename, count, len(points) // 2))
+    return points
+
+def normalize_lon(lon):
+    """Returns lon in [-180, 180), unchanged if it already is."""
+    lon = math.fmod(lon, 360.0)
+    if lon < -180:
+        lon += 360
+    elif lon >= 180:
+        lon -= 360
+    return lon
+
+class TZMap(object):
+    """The time zones of the world, as written by shapefile-to-json.py
+    to the directory path.
+
+    The zones are read from world-map.json, or, if index is true, from
+    world-map.index (see shapefile-to-json.py --index), and their points
+    from world-map.data, in either of its formats.  If grid is true and
+    world-map-grid.json exists (see shapefile-to-json.py --grid), zone_at
+    uses it to test only the zones that might contain each point.
+    Lookups don't change anything, so one TZMap can be shared between
+    threads."""
+
+    def __init__(self, path, index=False, grid=True):
+        if index:
+            self.__load_index(os.path.join(path, "world-map.index"))
+        else:
+            self.__load_json(os.path.join(path, "world-map.json"))
+        self.__points = _read_points(os.path.join(path, "world-map.data"))
+        self.__zoneIds = dict((tz, z) for (z, tz) in enumerate(self.__names))
+
+        self.__grid = None
+        gridFilename = os.path.join(path, "world-map-grid.json")
+        if grid and os.path.exists(gridFilename):
+            gridIO = open(gridFilename)
+            try:
+                self.__grid = json.load(gridIO)
+            finally:
+                gridIO.close()
+
+    def __load_json(self, jsonFilename):
+        jsonIO = open(jsonFilename)
+        try:
+            world = json.load(jsonIO)
+        finally:
+            jsonIO.close()
+        self.__names = sorted(world["zones"])
+        self.__zonePolygons = array.array("I", [0])
+        self.__polygonChains = array.array("I", [0])
+        self.__chains = array.array("i")
+        bboxes = world.get("bboxes")
+        if bboxes is not None:
+            self.__zoneBboxes = array.array("d")
+            self.__polygonBboxes = array.array("d")
+        else:
+            self.__zoneBboxes = self.__polygonBboxes = None
+        for tz in self.__names:
+            if bboxes is not None:
+                self.__zoneBboxes.extend(bboxes[tz]["zone"])
+                for bbox in bboxes[tz]["polygons"]:
+                    self.__polygonBboxes.extend(bbox)
+            for polygon in world["zones"][tz]:
+                for chain in polygon:
+                    self.__chains.extend(chain)
+                self.__polygonChains.append(len(self.__chains) // 2)
+            self.__zonePolygons.append(len(self.__polygonChains) - 1)
+
+    def __load_index(self, indexFilename):
+        indexIO = open(indexFilename, "rb")
+        try:
+            data = indexIO.read()
+        finally:
+            indexIO.close()
+        if len(data) < INDEX_HEADER.size:
+            raise ValueError("{0}: not a zone index".format(indexFilename))
+        (magic, version, zoneCount, polygonCount, chainCount, namesLength) = \
+            INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("{0}: not a zone index".format(indexFilename))
+        offset = INDEX_HEADER.size
+        if len(data) != offset + (zoneCount + polygonCount) * 32 + \
+                        (zoneCount + polygonCount + 2) * 4 + \
+                        chainCount * 8 + namesLength:
+            raise ValueError("{0}: wrong length".format(indexFilename))
+        arrays = []
+        for (typecode, count) in (("d", zoneCount * 4),
+                                  ("d", polygonCount * 4),
+                                  ("I", zoneCount + 1),
+                                  ("I", polygonCount + 1),
+                                  ("i", chainCount * 2)):
+            arrays.append(_read_array(typecode, data, offset, count))
+            offset += count * arrays[-1].itemsize
+        (self.__zoneBboxes, self.__polygonBboxes, self.__zonePolygons,
+         self.__polygonChains, self.__chains) = arrays
+        names = data[offset:offset + namesLength].decode("utf-8")
+        self.__names = names.split("\n") if zoneCount else []
+
+    def all_zones(self):
+        """Returns a list of all the zone names, in alphabetical order,
+        including "uninhabited"."""
+        return list(self.__names)
+
+    def zone_contains(self, tz, lat, lon):
+        """Returns whether the zone named tz (e.g., "America/Los_Angeles")
+        contains the point at the given latitude and longitude or has it
+        on its boundary, False for unknown zones, and None at or past
+        the poles, like tzmap.js's zoneContains."""
+        if lat >= 90 or lat <= -90:
+            return None
+        z = self.__zoneIds.get(tz)
+        if z is None:
+            return False
+        return self.__zone_contains(z, lat, normalize_lon(lon))
+
+    def zone_at(self, lat, lon):
+        """Returns the name of the zone at the given latitude and
+        longitude, "uninhabited" for land with no known zone, or None
+        for water, like tzmap.js's zoneAt.  For a point on a boundary,
+        it returns one of the zones."""
+        if lat >= 90 or lat <= -90:
+            return None
+        lon = normalize_lon(lon)
+
+        grid = self.__grid
+        if grid is not None:
+            column = int(math.floor((lon - grid["west"]) / grid["cellSize"]))
+            row = int(math.floor((lat - grid["south"]) / grid["cellSize"]))
+            column = max(0, min(grid["columns"] - 1, column))
+            row = max(0, min(grid["rows"] - 1, row))
+            cell = grid["cells"][row * grid["columns"] + column]
+            if cell is None:
+                return None
+            if not isinstance(cell, list):
+                return grid["zones"][cell]
+            # Only the zones listed for the cell can contain the point.
+            for candidate in cell:
+                tz = grid["zones"][candidate]
+                z = self.__zoneIds.get(tz)
+                if z is not None and self.__zone_contains(z, lat, lon):
+                    return tz
+            return None
+
+        for z in range(len(self.__names)):
+            if self.__zone_contains(z, lat, lon):
+                return self.__names[z]
+        return None
+
+    def __zone_contains(self, z, lat, lon):
+        # The bounding boxes let us skip most zones (and most polygons
+        # of the rest) without looking at their points.
+        if self.__zoneBboxes is not None and \
+           not _bbox_contains(self.__zoneBboxes, z, lat, lon):
+            return False
+        for p in range(self.__zonePolygons[z], self.__zonePolygons[z + 1]):
+            if self.__polygonBboxes is not None and \
+               not _bbox_contains(self.__polygonBboxes, p, lat, lon):
+                continue
+            if self.__polygon_contains(p, lat, lon):
+                return True
+        return False
+
+    def __polygon_contains(self, p, lat, lon):
+        # Count the edges crossing the line north from the point, as
+        # tzmap.js does; see zoneContains there.  Which way a chain is
+        # run doesn't change which of its edges cross.
+        points = self.__points
+        chains = self.__chains
+        intersects = 0
+        for c in range(self.__polygonChains[p], self.__polygonChains[p + 1]):
+            (start, end) = (chains[2 * c], chains[2 * c + 1])
+            if start > end:
+                (start, end) = (end, start)
+            lons = points[2 * start:2 * end:2]
+            lats = points[2 * start + 1:2 * end:2]
+            for (prevlon, prevlat, ptlon, ptlat) in \
+                    zip(lons, lats, lons[1:], lats[1:]):
+                if ptlon == prevlon:
+                    # A vertical edge only matters if the point is on it.
+                    if ptlon == lon and \
+                       min(ptlat, prevlat) <= lat <= max(ptlat, prevlat):
+                        return True
+                    continue
+                if abs(ptlon - prevlon) > 180:
+                    # The edge crosses the date line, so measure it in
+                    # [0, 360) instead.
+                    alon = (lon + 360) % 360
+                    ptalon = (ptlon + 360) % 360
+                    prevalon = (prevlon + 360) % 360
+                else:
+                    (alon, ptalon, prevalon) = (lon, ptlon, prevlon)
+                # Put the west end first; it is counted, and the east
+                # end isn't.
+                if ptalon < prevalon:
+                    (prevalon, prevlat, ptalon, ptlat) = \
+                        (ptalon, ptlat, prevalon, prevlat)
+                if prevalon <= alon < ptalon:
+                    xlat = prevlat + (ptlat - prevlat) * \
+                           ((alon - prevalon) / (ptalon - prevalon))
+                    if xlat == lat:
+                        # on the line
+                        return True
+                    if xlat > lat:
+                        intersects += 1
+        return intersects % 2 == 1
+
+def _bbox_contains(bboxes, idx, lat, lon):
+    """Returns whether the point is in the idx'th [west, south, east,
+    north] box in the flat array bboxes, which crosses the date line if
+    west > east."""
+    (west, south, east, north) = bboxes[4 * idx:4 * idx + 4]
+    if lat < south or lat > north:
+        return False
+    if west <= east:
+        return west <= lon <= east
+    return west <= lon or lon <= east